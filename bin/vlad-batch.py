@@ -0,0 +1,9 @@
+#
+# vlad-batch.py
+# 
+# Runs Vlad over many query sets (GMT or TSV file) from the command line.
+#
+import sys
+from libvlad import VladBatch
+
+VladBatch().go(sys.argv)
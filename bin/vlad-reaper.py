@@ -0,0 +1,36 @@
+#
+# vlad-reaper.py
+#
+# Removes expired Vlad output (run directories, job directories) from the
+# output directory, using its manifest (see RunManifest in libvlad/Vlad.py).
+# Run it from cron, e.g. hourly, and the CGI need not be run with --cleanTempFiles.
+#
+# Usage:
+#    python vlad-reaper.py config.cfg [--scan]
+# With --scan, also walks the whole output directory and removes files older
+# than maxAge (e.g. output from before there was a manifest), except those of
+# unexpired manifest entries.
+#
+import sys
+import time
+from libvlad import Vlad
+from libvlad.Vlad import RunManifest, TempFileCleaner
+
+def main(argv):
+    args = [a for a in argv[1:] if not a.startswith("--")]
+    if len(args) != 1:
+        sys.stderr.write("usage: %s config.cfg [--scan]\n" % argv[0])
+        sys.exit(-1)
+    cp = Vlad().cfgParser
+    cp.read(args[0])
+    outputdir = cp.get("VLAD", "outputdir")
+    maxage = cp.getfloat("VLAD", "maxage", fallback=1)*24*3600
+    m = RunManifest(outputdir)
+    n = m.expire()
+    keep = m.getNames()
+    m.close()
+    if "--scan" in argv:
+        TempFileCleaner(outputdir, maxage, keep).go()
+    sys.stderr.write("%s vlad-reaper: removed %d expired entries.\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), n))
+
+main(sys.argv)
@@ -0,0 +1,10 @@
+#
+# vlad-server.py
+# 
+# Runs the Vlad analysis server, which keeps data loaded between requests.
+# See libvlad/Server.py.
+#
+import sys
+from libvlad import Server
+
+Server.main(sys.argv)
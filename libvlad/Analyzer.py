@@ -2,9 +2,12 @@
 # Analyzer.py
 #
 
+import os
 import types
 import math
 import sys
+import threading
+import weakref
 
 from . import DAG
 from . import Stats
@@ -18,37 +21,81 @@ PERCENTAGE = "percentage"
 #-----------------------------------------------------
 
 class EnrichmentAnalyzer(object):
+    # Max number of closures to keep in the cache. (The oldest is dropped.)
+    MAXCACHEDCLOSURES = 64
+
     #----------------------------------------------
     def __init__(self):
-        self.cachedClosures = {}
+        self.cachedClosures = {}    # key -> (weakref to annotation set, closure)
+        self.lock = threading.RLock()    # (RLock: weakref callbacks can run at any time)
+        os.register_at_fork(after_in_child=self.__afterfork__)
+
+    def __afterfork__(self):
+        # (another thread may have held the lock when this process was forked)
+        self.lock = threading.RLock()
 
     #----------------------------------------------
-    def computeAnnotationClosure(self, ontology, namespace, annotations, excludeCodes, universe):
+    def dropClosures(self, data):
+        '''
+        Removes cached closures computed from the given ontology or
+        annotation set (e.g., because it has been reloaded).
+        '''
+        self.dropClosuresFor(id(data))
+        with self.lock:
+            for key in list(self.cachedClosures.keys()):
+                if key[0] is data:
+                    self.cachedClosures.pop(key, None)
+
+    def dropClosuresFor(self, annotid):
+        '''
+        Removes cached closures of the annotation set whose id() is annotid.
+        (Also called when the set is freed, so that a later set that happens
+        to get the same id never finds them.)
+        '''
+        with self.lock:
+            for key in list(self.cachedClosures.keys()):
+                if key[2] == annotid:
+                    self.cachedClosures.pop(key, None)
+
+    #----------------------------------------------
+    def computeAnnotationClosure(self, ontology, namespace, annotations, excludeCodes, universe, filters=None):
         '''
         Computes the closure of annotations over the given namespace.
         Returns a dictionary mapping each term
         to the set of objects (ids) annotated to that term or its
         descendants. Excludes "NOT" annotations and those
-        whose evidence codes are in the excludCodes set. Closure
-        computation only crosses "is_a" and "part_of" edges.
+        whose evidence codes are in the excludCodes set. If filters
+        is given, it is a dict of keyword args for annotations.getFilter
+        (e.g. {'taxa':['10090']}), and only matching annotations are used.
+        Closure computation only crosses "is_a" and "part_of" edges.
         Closures are cached and reused if possible.
         '''
         if universe is None:
             universe = []
         universe = frozenset(universe)
         excludeCodes = frozenset(excludeCodes)
-        key = (ontology, namespace, id(annotations), excludeCodes, universe)
-        ac = self.cachedClosures.get(key, None)
+        filters = filters or {}
+        fkey = tuple(sorted([ (n, str(v)) for (n,v) in filters.items() if v ]))
+        # (annotation sets are lists, hence unhashable; key on the id, and
+        # check the weakref to make sure it's the same set)
+        key = (ontology, namespace, id(annotations), excludeCodes, universe, fkey)
+        entry = self.cachedClosures.get(key, None)
+        ac = None
+        if entry is not None and entry[0]() is annotations:
+            ac = entry[1]
         if ac is None:
-            def annotFilt(a):
-                return a.getQualifier() != 'NOT' \
-                   and a.getEvidenceCode() not in excludeCodes \
-                   and (len(universe)==0 or a.getObjId() in universe)
+            colFilt = annotations.getFilter(**filters)
             def edgeFilt(d):
                 return d in ['is_a', 'part_of']
             startNodes = ontology.getRoot(namespace)
-            ac = AnnotationClosure(annotations,annotFilt,edgeFilt).go(ontology, startNodes)
-            self.cachedClosures[key] = ac
+            order = ontology.getNamespaceOrder(namespace)
+            ac = AnnotationClosure(annotations, excludeCodes, universe, colFilt, edgeFilt).go(
+                ontology, startNodes, order=order)
+            ref = weakref.ref(annotations, lambda r, annotid=id(annotations): self.dropClosuresFor(annotid))
+            with self.lock:
+                while len(self.cachedClosures) >= self.MAXCACHEDCLOSURES:
+                    self.cachedClosures.pop(next(iter(self.cachedClosures)), None)
+                self.cachedClosures[key] = (ref, ac)
         return ac
 
     #----------------------------------------------
@@ -61,7 +108,8 @@ class EnrichmentAnalyzer(object):
                 annotations,    # AnnotationSet
                 excludeCodes,   # set(string)
                 termminmax,     # { term -> [minP, maxP, minQ, maxQ] }
-                analysis):      # "enrichment" or "depletion" or "percentage"
+                analysis,       # "enrichment" or "depletion" or "percentage"
+                filters=None):  # { name -> values }, see AnnotationSet.getFilter
         '''
         Performs enrichment analysis for a given query set against a given 
         ontology+namespace, over a given annotation data set.
@@ -77,7 +125,7 @@ class EnrichmentAnalyzer(object):
         # compute the annotation closure, a map from terms to all objects
         # annotated to terms or descendants
         annotClosure = self.computeAnnotationClosure(
-                ontology,namespace,annotations,excludeCodes,universe)
+                ontology,namespace,annotations,excludeCodes,universe,filters)
         # universe set is set of objects annotated to the root
         uset = set()
         for sn in ontology.getRoot(namespace):
@@ -168,7 +216,8 @@ class EnrichmentAnalyzer(object):
                 ontology,       # Ontology
                 annotations,    # AnnotationSet
                 excludeCodes=set(),  # set(string) - evidence codes to exclude
-                analysis=ENRICHMENT ):
+                analysis=ENRICHMENT,
+                filters=None ):      # { name -> values } - annotation filters (see AnnotationSet.getFilter)
         '''
         Performs enrichment analysis for a list of query sets against a given ontology
         over a given set of annotations. 
@@ -208,7 +257,7 @@ class EnrichmentAnalyzer(object):
             for (i,qset) in enumerate(qsets):
                 # analyze one query set against one namespace (DAG)
                 qsnf, qsres = self.__analyze__(
-                    qsnames[i], qset, universe, ontology,ns,annotations,excludeCodes,termminmax,analysis)
+                    qsnames[i], qset, universe, ontology,ns,annotations,excludeCodes,termminmax,analysis,filters)
                 notfound[ns].append(qsnf)
                 results[ns] += qsres
                 for r in qsres:
@@ -292,37 +341,59 @@ class AnnotationClosure(DAG.Traversal):
     '''
     A traversal subclass that computes the closure of annotations to each
     term and its descendents. The result is a mapping from term to the
-    set of annotated object ids. The traversal can be customized to avoid
-    crossing certain edges and/or including certain annotations. To avoid
-    crossing specific edges, specify edgeFilter in the constructor call.
-    This is a function, f(p,c,d), which is passed each edge before crossing.
-    The edge is passed as p=parent node, c=child node, d=edge data. The
+    set of annotated object ids. "NOT" annotations are never included.
+    The traversal can be customized to avoid crossing certain edges and/or 
+    including certain annotations. To avoid crossing specific edges, specify
+    edgeFilter in the constructor call. This is a function, f(d), which is 
+    passed the data (relationship type) of each edge before crossing. The
     function should return True to cross the edge and False to not cross.
-    Similarly, specific annotations can be excluded by passing annotFilter,
-    a function, f(a), that is passed each annotation and returns True to
-    include the annotation and False to exclude it.
+    Annotations can be excluded by evidence code (excludeCodes), by object
+    (universe; if not empty, only these objects are included), and by 
+    passing annotFilter, a function, f(a), that is passed each annotation
+    and returns True to include the annotation and False to exclude it.
+    The annotations are used in compiled form (see 
+    AnnotationSet.getTermObjects); annotFilter, if given, is applied while
+    compiling.
     '''
     def __init__(self, 
                 annots, 
-                annotFilter = lambda x:True, 
+                excludeCodes = (),
+                universe = (),
+                annotFilter = None,
                 edgeFilter = lambda e: True):
         self.annots = annots
+        self.excludeCodes = excludeCodes
+        self.universe = universe
         self.annotFilter = annotFilter
         self.edgeFilter = edgeFilter
         self.term2objs = {}
 
-    def beforeNode(self, dag, term, path):
-        oset = set()
-        for a in self.annots.getAnnotsForTerm(term.id):
-            if self.annotFilter(a):
-                oset.add(a.getObjId())
-        self.term2objs[term] = oset
-
-    def beforeEdge(self, dag, p, c, d, path):
-        return self.edgeFilter(d)
-
-    def afterEdge(self, dag, p, c, d, path):
-        self.term2objs[p] |= self.term2objs[c]
+    def go(self, dag, startNodes=None, reversed=False, allPaths=False, order=None):
+        '''
+        Computes the closure with two sweeps over a topological ordering of
+        the terms (optionally confined to the given order, e.g. one namespace):
+        a forward sweep to find the terms reachable from the start nodes, and a
+        backward sweep that rolls each term's objects up into its parents.
+        '''
+        self.dag = dag
+        self.startNodes = startNodes
+        edgeFilt = lambda p,c,d: self.edgeFilter(d)
+        terms = dag.getSweepOrder(startNodes, edgeFilt=edgeFilt, order=order)
+        excluded = self.annots.getEvidenceMask(self.excludeCodes)
+        universe = self.universe
+        term2objs = {}
+        for term in terms[::-1]:
+            oset = set([ oid for (oid, bits, isnot) 
+                in self.annots.getTermObjects(term.id, self.annotFilter) 
+                if not isnot and bits & ~excluded ])
+            if universe:
+                oset &= universe
+            for (c,d) in dag.iterOutEdges(term):
+                if self.edgeFilter(d):
+                    oset |= term2objs[c]
+            term2objs[term] = oset
+        self.term2objs = term2objs
+        return self.getResults()
 
     def getResults(self):
         return self.term2objs
@@ -2,9 +2,17 @@
 # Annotation.py
 #
 
+import os
 import sys
 import types
 import string
+import heapq
+import tempfile
+import threading
+import functools
+import multiprocessing
+
+from . import FileTools
 
 #------------------------------------------------------------------
 
@@ -50,6 +58,37 @@ class Annotation(object):
     def getEvidenceCode(self):
         return self.tokens[ self.Evidence_code ]
 
+    def getObjType(self):
+        return self.tokens[ self.DB_Object_Type ]
+
+    def getTaxon(self):
+        # first taxon only (the second, if any, is the interacting taxon),
+        # without the "taxon:" prefix
+        return self.tokens[ self.Taxon ].split('|')[0].replace('taxon:','')
+
+    def getDate(self):
+        return self.tokens[ self.Date ]
+
+    def getAssignedBy(self):
+        return self.tokens[ self.Assigned_by ]
+
+class AnnotationRecord(Annotation):
+    '''
+    The parts of an annotation kept by a SpooledAnnotationSet: term id,
+    object id, evidence code, qualifier, and the filter columns (taxon, 
+    assigned by, date, object type). The other columns are empty.
+    '''
+    def __init__(self, termId, objId, evidence, qualifier, taxon, assignedBy, date, objType):
+        self.tokens = [''] * 15
+        self.tokens[ self.GO_ID ] = termId
+        self.tokens[ self.DB_Object_ID ] = objId
+        self.tokens[ self.Evidence_code ] = evidence
+        self.tokens[ self.Qualifier ] = qualifier
+        self.tokens[ self.Taxon ] = taxon
+        self.tokens[ self.Assigned_by ] = assignedBy
+        self.tokens[ self.Date ] = date
+        self.tokens[ self.DB_Object_Type ] = objType
+
 #------------------------------------------------------------------
 
 class DBObject(object):
@@ -73,7 +112,27 @@ class DBObject(object):
 
 #------------------------------------------------------------------
 
+# Guards the assignment of evidence code bits (see getEvidenceBit).
+__bitlock__ = threading.Lock()
+
+def __afterfork__():
+    # (another thread may have held the lock when this process was forked)
+    global __bitlock__
+    __bitlock__ = threading.Lock()
+
+os.register_at_fork(after_in_child=__afterfork__)
+
 class AnnotationSet(list):
+
+    # Columns that can be indexed for filtering (see getFilter),
+    # and how to get each one's value from an annotation.
+    INDEXCOLUMNS = {
+        'taxon'         : Annotation.getTaxon,
+        'assignedBy'    : Annotation.getAssignedBy,
+        'date'          : Annotation.getDate,
+        'objtype'       : Annotation.getObjType,
+        }
+
     def __init__(self):
         list.__init__(self)
         self.attributes = {}
@@ -81,11 +140,15 @@ class AnnotationSet(list):
         self.id2dbobj = {}
         self.symbol2id = {}
         self.termid2annots = {}
+        self.indexes = {}
+        self.compiled = {}
+        self.evcode2bit = {}
 
     def getAttribute(self, attr, dflt="???"):
         return self.attributes.get(attr, dflt)
 
     def append(self, a):
+        a.index = len(self)
         list.append(self, a)
         oid = a.getObjId()
         if oid not in self.id2dbobj:
@@ -94,9 +157,106 @@ class AnnotationSet(list):
             self.symbol2id[dbo.symbol] = oid
         self.termid2annots.setdefault(a.getTermId(), []).append(a)
 
+    def finish(self):
+        '''
+        Called by the loader after the last annotation has been appended.
+        '''
+        pass
+
     def getAnnotsForTerm(self, termid):
         return self.termid2annots.get(termid,[])
 
+    def getEvidenceBit(self, code):
+        '''
+        Returns the bit assigned to the given evidence code. Bits are 
+        assigned in order of first use.
+        '''
+        bit = self.evcode2bit.get(code, None)
+        if bit is None:
+            # (sets can be shared by threads, e.g., in the Vlad server)
+            with __bitlock__:
+                bit = self.evcode2bit.get(code, None)
+                if bit is None:
+                    bit = self.evcode2bit[code] = 1 << len(self.evcode2bit)
+        return bit
+
+    def getEvidenceMask(self, codes):
+        '''
+        Returns the bitwise OR of the bits for the given evidence codes.
+        '''
+        mask = 0
+        for c in codes:
+            mask |= self.getEvidenceBit(c)
+        return mask
+
+    def compileAnnots(self, annots, filt=None):
+        '''
+        Reduces a list of annotations (to one term) to a list of distinct 
+        tuples, (objid, evbits, isnot), where evbits has the bits of all the 
+        evidence codes for that object (see getEvidenceBit), and isnot is
+        True for "NOT" annotations. If filt is given, only annotations for 
+        which filt(a) is True are included.
+        '''
+        pairs = {}
+        for a in annots:
+            if filt is None or filt(a):
+                key = (a.getObjId(), a.getQualifier() == 'NOT')
+                pairs[key] = pairs.get(key, 0) | self.getEvidenceBit(a.getEvidenceCode())
+        return [ (oid, bits, isnot) for ((oid, isnot), bits) in pairs.items() ]
+
+    def getTermObjects(self, termid, filt=None):
+        '''
+        Returns the compiled annotations for a term (see compileAnnots). 
+        The unfiltered results are cached.
+        '''
+        if filt is not None:
+            return self.compileAnnots(self.getAnnotsForTerm(termid), filt)
+        tobjs = self.compiled.get(termid, None)
+        if tobjs is None:
+            tobjs = self.compiled[termid] = self.compileAnnots(self.getAnnotsForTerm(termid))
+        return tobjs
+
+    def getIndex(self, column):
+        '''
+        Returns the index for the given column (one of INDEXCOLUMNS). The index
+        maps each value in the column to the set of positions (a.index) of the 
+        annotations having that value. Indexes are built on first use.
+        '''
+        idx = self.indexes.get(column, None)
+        if idx is None:
+            getter = self.INDEXCOLUMNS[column]
+            idx = {}
+            for a in self:
+                idx.setdefault(getter(a), set()).add(a.index)
+            self.indexes[column] = idx
+        return idx
+
+    def getFilter(self, taxa=None, assignedBy=None, objtypes=None, since=None):
+        '''
+        Returns a function, f(a), that returns True for annotations meeting all
+        of the given criteria, or None if no criteria are given. taxa, assignedBy,
+        and objtypes are lists of allowed values. since is a date (YYYYMMDD);
+        annotations dated earlier are excluded. The criteria are evaluated once,
+        against the column indexes, so f is just a set lookup.
+        '''
+        mask = None
+        for (column, values) in [('taxon',taxa), ('assignedBy',assignedBy), ('objtype',objtypes)]:
+            if values:
+                idx = self.getIndex(column)
+                m = set()
+                for v in values:
+                    m |= idx.get(v, set())
+                mask = m if mask is None else mask & m
+        if since:
+            m = set()
+            for (d, ps) in self.getIndex('date').items():
+                if d >= since:
+                    m |= ps
+            mask = m if mask is None else mask & m
+        if mask is None:
+            return None
+        return lambda a: a.index in mask
+
     def resolve(self, labels):
         '''
         Resolves a collection of ids and/or symbols (possibly with duplicates)
@@ -130,6 +290,222 @@ class AnnotationSet(list):
 
 #------------------------------------------------------------------
 
+class SpooledAnnotationSet(AnnotationSet):
+    '''
+    An AnnotationSet for annotation files that are too big to hold in memory.
+    Only the parts of each annotation used in the analysis are kept (term id,
+    object id, evidence code, qualifier, filter columns; see AnnotationRecord).
+    These are
+    buffered, and whenever the buffer reaches the memory budget (in bytes)
+    it is sorted and spilled to a temporary file (a "run"). finish() merges
+    the runs into a single file sorted by term, dropping duplicates, and 
+    indexes it by term id. (len() is then the number of distinct records;
+    iterating over the set reads them all back.) getAnnotsForTerm reads a term's annotations back
+    from that file, so the closure computation (which visits each term 
+    once) only ever has one term's annotations in memory.
+
+    DB objects (ids and symbols), attributes, and comments are still kept 
+    in memory.
+    '''
+    # Initial estimate of the size (bytes) of one buffered record, for the
+    # memory budget, until SAMPLESIZE records have been buffered and measured.
+    RECORDSIZE = 600
+    SAMPLESIZE = 1000
+
+    def __init__(self, memoryBudget):
+        AnnotationSet.__init__(self)
+        self.memoryBudget = memoryBudget
+        self.measured = False
+        self.maxBuffered = max(self.SAMPLESIZE, memoryBudget // self.RECORDSIZE)
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+        self.spoolfile = None
+        self.term2extent = {}
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # (the list itself is empty; the annotations are in the spool file)
+        for termid in self.term2extent:
+            for a in self.getAnnotsForTerm(termid):
+                yield a
+
+    def append(self, a):
+        oid = a.getObjId()
+        if oid not in self.id2dbobj:
+            dbo = DBObject(a)
+            self.id2dbobj[oid] = dbo
+            self.symbol2id[dbo.symbol] = oid
+        self.buffer.append( (a.getTermId(), oid, a.getEvidenceCode(), a.getQualifier(),
+            a.getTaxon(), a.getAssignedBy(), a.getDate(), a.getObjType()) )
+        self.count += 1
+        if not self.measured and len(self.buffer) == self.SAMPLESIZE:
+            self.__measure__()
+        if len(self.buffer) >= self.maxBuffered:
+            self.__spill__()
+
+    def __measure__(self):
+        # size of the buffered records: tuples, list slots, and their strings
+        # (each distinct string once, as repeated values are shared)
+        seen = set()
+        size = 0
+        for r in self.buffer:
+            size += sys.getsizeof(r) + 8
+            for v in r:
+                if id(v) not in seen:
+                    seen.add(id(v))
+                    size += sys.getsizeof(v)
+        recordSize = max(1, size // len(self.buffer))
+        self.maxBuffered = max(self.SAMPLESIZE, self.memoryBudget // recordSize)
+        self.measured = True
+
+    def __spill__(self):
+        self.buffer.sort()
+        fd = tempfile.TemporaryFile()
+        fd.writelines( ('\t'.join(r) + '\n').encode('utf-8') for r in self.buffer )
+        fd.seek(0)
+        self.runs.append(fd)
+        self.buffer = []
+
+    def __readrun__(self, fd):
+        for line in fd:
+            yield tuple(line.decode('utf-8')[:-1].split('\t'))
+
+    def finish(self):
+        self.buffer.sort()
+        runs = [ self.__readrun__(fd) for fd in self.runs ] + [ iter(self.buffer) ]
+        self.spoolfile = fd = tempfile.TemporaryFile()
+        self.term2extent = t2e = {}
+        prev = None
+        start = 0
+        self.count = 0
+        for r in heapq.merge(*runs):
+            if r == prev:
+                continue
+            self.count += 1
+            if prev is None or r[0] != prev[0]:
+                if prev is not None:
+                    t2e[prev[0]] = (start, fd.tell())
+                start = fd.tell()
+            fd.write( ('\t'.join(r[1:]) + '\n').encode('utf-8') )
+            prev = r
+        if prev is not None:
+            t2e[prev[0]] = (start, fd.tell())
+        fd.flush()
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+
+    def getAnnotsForTerm(self, termid):
+        extent = self.term2extent.get(termid)
+        if extent is None:
+            return []
+        (start, end) = extent
+        # (pread, not seek+read: the file offset is shared with other threads,
+        # and with forked processes)
+        lines = os.pread(self.spoolfile.fileno(), end - start, start).decode('utf-8').split('\n')
+        return [ AnnotationRecord(termid, *l.split('\t')) for l in lines[:-1] ]
+
+    def getTermObjects(self, termid, filt=None):
+        # not cached
+        return self.compileAnnots(self.getAnnotsForTerm(termid), filt)
+
+    def getFilter(self, taxa=None, assignedBy=None, objtypes=None, since=None):
+        return makeColumnFilter(taxa, assignedBy, objtypes, since)
+
+#------------------------------------------------------------------
+
+class CompactAnnotationSet(AnnotationSet):
+    '''
+    An AnnotationSet built from the partial indexes returned by parseChunk,
+    i.e., by a parallel load. Each chunk's annotations come already grouped
+    by term, as compact records (see AnnotationRecord), along with the
+    term's annotations in compiled form (see compileAnnots). The parent
+    process just merges these, per term and per object, rather than handling
+    every annotation. Records are only turned into annotation objects when
+    a term's annotations are asked for (e.g., when filtering).
+    '''
+    def __init__(self):
+        AnnotationSet.__init__(self)
+        self.count = 0
+        self.term2records = {}  # term id -> [ records text (one per chunk) ]
+        self.term2parts = {}    # term id -> [ compiled pairs (one per chunk) ]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for termid in self.term2records:
+            for a in self.getAnnotsForTerm(termid):
+                yield a
+
+    def addPart(self, part):
+        '''
+        Merges one chunk's partial index (see parseChunk) into the set.
+        '''
+        (headers, count, objs, term2records, term2pairs) = part
+        self.count += count
+        for oid, (db, symbol) in objs.items():
+            if oid not in self.id2dbobj:
+                dbo = DBObject(Annotation([db, oid, symbol] + ['']*12))
+                self.id2dbobj[oid] = dbo
+                self.symbol2id[dbo.symbol] = oid
+        for termid, records in term2records.items():
+            self.term2records.setdefault(termid, []).append(records)
+        for termid, pairs in term2pairs.items():
+            self.term2parts.setdefault(termid, []).append(pairs)
+
+    def getAnnotsForTerm(self, termid):
+        annots = []
+        for records in self.term2records.get(termid, []):
+            annots.extend([ AnnotationRecord(termid, *l.split('\t')) for l in records.split('\n')[:-1] ])
+        return annots
+
+    def getTermObjects(self, termid, filt=None):
+        if filt is not None:
+            return self.compileAnnots(self.getAnnotsForTerm(termid), filt)
+        tobjs = self.compiled.get(termid, None)
+        if tobjs is None:
+            pairs = {}
+            for part in self.term2parts.get(termid, []):
+                for (oid, isnot, codes) in part:
+                    key = (oid, isnot)
+                    pairs[key] = pairs.get(key, 0) | self.getEvidenceMask(codes)
+            tobjs = self.compiled[termid] = [ (oid, bits, isnot) for ((oid, isnot), bits) in pairs.items() ]
+        return tobjs
+
+    def getFilter(self, taxa=None, assignedBy=None, objtypes=None, since=None):
+        return makeColumnFilter(taxa, assignedBy, objtypes, since)
+
+#------------------------------------------------------------------
+
+def makeColumnFilter(taxa=None, assignedBy=None, objtypes=None, since=None):
+    '''
+    Same as AnnotationSet.getFilter, except that there are no indexes; f
+    checks the column values of each annotation. (For annotation sets that
+    don't keep all their annotations in memory.)
+    '''
+    tests = []
+    if taxa:
+        taxa = set(taxa)
+        tests.append(lambda a: a.getTaxon() in taxa)
+    if assignedBy:
+        assignedBy = set(assignedBy)
+        tests.append(lambda a: a.getAssignedBy() in assignedBy)
+    if objtypes:
+        objtypes = set(objtypes)
+        tests.append(lambda a: a.getObjType() in objtypes)
+    if since:
+        tests.append(lambda a: a.getDate() >= since)
+    if not tests:
+        return None
+    return lambda a: all([t(a) for t in tests])
+
+#------------------------------------------------------------------
+
 class AnnotationParser(object):
     '''
     Parser for GO annotation file format. This is a TAB-delimited ASCII
@@ -144,6 +520,9 @@ class AnnotationParser(object):
 
        http://www.geneontology.org/GO.format.annotation.shtml
 
+    Files may be gzip- or zstd-compressed (see FileTools). (For parsing in
+    parallel, see AnnotationLoader and parseChunk.)
+
     The user instantiates the parser with up to three callback functions:
        commentHandler(c)     - Called with the contents of each comment line (string).
        attributeHandler(n,v) - Called with each name, value attribute (string, string).
@@ -156,7 +535,7 @@ class AnnotationParser(object):
 
     def parseFile(self, file):
         if type(file) is str:
-            self.fd = open(file, 'r')
+            self.fd = FileTools.openInput(file, 'r')
         else:
             self.fd = file
         self.__go__()
@@ -168,20 +547,134 @@ class AnnotationParser(object):
         tokens[-1] = tokens[-1].strip()
         return Annotation(tokens)
 
+    def __parseheader__(self, line):
+        if line.startswith('! '):
+            self.commentHandler and self.commentHandler( line[2:] )
+        elif len(line) > 2 and self.attributeHandler:
+            try:
+                (n,v) = list(map(str.strip, line[1:].split(":",1)))
+                self.attributeHandler(n,v)
+            except:
+                pass
+
     def __go__(self):
         for line in self.fd:
-            if line.startswith('! '):
-                self.commentHandler and self.commentHandler( line[2:] )
-            elif line.startswith('!'):
-                if len(line) > 2 and self.attributeHandler:
-                    try:
-                        (n,v) = list(map(str.strip, line[1:].split(":",1)))
-                        self.attributeHandler(n,v)
-                    except:
-                        pass
+            if line.startswith('!'):
+                self.__parseheader__(line)
             elif self.annotHandler:
                 self.annotHandler(self.__parseannot__(line))
 
+#------------------------------------------------------------------
+# Parallel parsing support. A file is divided into chunks of whole
+# lines, each roughly CHUNKSIZE bytes. An uncompressed file is divided
+# by byte range (start,end), and each worker reads its own range. A 
+# compressed file is decompressed by the main process, and the chunks
+# themselves (bytes) are handed to the workers.
+
+CHUNKSIZE = 8 * 1024 * 1024
+
+def splitFile(fname, chunksize=CHUNKSIZE):
+    '''
+    Returns a list of (fname, start, end) byte ranges covering the file.
+    Each range ends just after a newline (or at end of file).
+    '''
+    size = os.path.getsize(fname)
+    ranges = []
+    fd = open(fname, 'rb')
+    start = 0
+    while start < size:
+        fd.seek(start + chunksize)
+        fd.readline()
+        end = min(fd.tell(), size)
+        ranges.append( (fname, start, end) )
+        start = end
+    fd.close()
+    return ranges
+
+def readChunks(fname, chunksize=CHUNKSIZE):
+    '''
+    Generates successive blocks of whole lines (bytes) from the file, which 
+    may be compressed.
+    '''
+    fd = FileTools.openInput(fname)
+    rest = b''
+    while True:
+        block = fd.read(chunksize)
+        if not block:
+            break
+        block = rest + block
+        i = block.rfind(b'\n') + 1
+        rest = block[i:]
+        if i:
+            yield block[:i]
+    fd.close()
+    if rest:
+        yield rest
+
+def parseChunk(chunk, taxa=(), dbs=(), objtypes=()):
+    '''
+    Parses one chunk of an annotation file. The chunk is either a
+    (fname, start, end) byte range or a block of bytes. Annotations not in
+    the given taxa, dbs, and objtypes (if not empty) are skipped. Returns
+    a partial index of the chunk (see CompactAnnotationSet.addPart), a tuple
+    (headers, count, objs, term2records, term2pairs), where:
+        headers      = the list of "!" lines
+        count        = the number of annotations
+        objs         = { object id -> (db, symbol) }
+        term2records = { term id -> records text }, one line per annotation,
+                       the AnnotationRecord fields (after the term id), TAB
+                       separated
+        term2pairs   = { term id -> [ (object id, isnot, evidence codes) ] },
+                       the term's annotations in compiled form, except that
+                       the codes (a tuple) aren't yet turned into bits.
+    This is much smaller than the annotations themselves, so it is quick to
+    send back to the main process, and quick to merge there.
+    '''
+    if type(chunk) is tuple:
+        (fname, start, end) = chunk
+        fd = open(fname, 'rb')
+        fd.seek(start)
+        chunk = fd.read(end - start)
+        fd.close()
+    headers = []
+    count = 0
+    objs = {}
+    term2lines = {}
+    term2codes = {}
+    A = Annotation
+    for line in chunk.decode('utf-8').split('\n'):
+        if not line:
+            continue
+        if line.startswith('!'):
+            headers.append(line + '\n')
+            continue
+        t = line.split('\t')
+        t[-1] = t[-1].strip()
+        if len(t) < 15:
+            t += [''] * (15 - len(t))
+        taxon = t[A.Taxon].split('|')[0].replace('taxon:','')
+        if taxa and taxon not in taxa:
+            continue
+        if dbs and t[A.DB] not in dbs:
+            continue
+        if objtypes and t[A.DB_Object_Type] not in objtypes:
+            continue
+        count += 1
+        oid = t[A.DB_Object_ID]
+        if oid not in objs:
+            objs[oid] = (t[A.DB], t[A.DB_Object_Symbol])
+        termid = t[A.GO_ID]
+        evidence = t[A.Evidence_code].upper()
+        qualifier = t[A.Qualifier]
+        term2lines.setdefault(termid, []).append('\t'.join(
+            (oid, evidence, qualifier, taxon, t[A.Assigned_by], t[A.Date], t[A.DB_Object_Type])))
+        term2codes.setdefault(termid, {}).setdefault((oid, qualifier == 'NOT'), set()).add(evidence)
+    term2records = dict([ (termid, '\n'.join(lines) + '\n') for (termid, lines) in term2lines.items() ])
+    term2pairs = {}
+    for termid, pairs in term2codes.items():
+        term2pairs[termid] = [ (oid, isnot, tuple(codes)) for ((oid, isnot), codes) in pairs.items() ]
+    return (headers, count, objs, term2records, term2pairs)
+
 #------------------------------------------------------------------
 
 class AnnotationLoader(object):
@@ -191,12 +684,53 @@ class AnnotationLoader(object):
             attributeHandler=self.__handleAttribute__,
             commentHandler=self.__handleComment__)
 
-    def loadFile(self, file, config = None):
-        self.annotations = AnnotationSet()
+    def loadFile(self, file, config = None, nprocs = 1, memoryBudget = None):
+        '''
+        Loads the annotation file. If memoryBudget (bytes) is given, returns a
+        SpooledAnnotationSet that holds the annotations on disk, and parses
+        serially. Otherwise, if nprocs > 1 (at most the number of CPUs) and
+        the file is large, parses it in parallel, and returns a
+        CompactAnnotationSet. Annotations can be filtered as they are read, according to
+        the taxa, dbs, and objtypes (lists) in the config; an empty or missing
+        list means no filtering.
+        '''
+        nprocs = min(nprocs, os.cpu_count() or 1)
+        parallel = nprocs > 1 and not memoryBudget \
+            and type(file) is str and os.path.getsize(file) > CHUNKSIZE
+        if memoryBudget:
+            self.annotations = SpooledAnnotationSet(memoryBudget)
+        elif parallel:
+            self.annotations = CompactAnnotationSet()
+        else:
+            self.annotations = AnnotationSet()
         self.annotations.config = config
-        self.parser.parseFile(file)
+        self.taxa = set([ t.replace('taxon:','') for t in getattr(config, 'taxa', []) ])
+        self.dbs = set(getattr(config, 'dbs', []))
+        self.objtypes = set(getattr(config, 'objtypes', []))
+        if parallel:
+            self.__loadparallel__(file, nprocs)
+        else:
+            self.parser.parseFile(file)
+        self.annotations.finish()
         return self.annotations
 
+    def __loadparallel__(self, fname, nprocs):
+        '''
+        Splits the file into blocks of whole lines, which are parsed by a pool
+        of nprocs worker processes (see parseChunk). The partial indexes they
+        return are merged in the main process, in file order.
+        '''
+        if FileTools.getCompression(fname):
+            chunks = readChunks(fname, CHUNKSIZE)
+        else:
+            chunks = splitFile(fname, CHUNKSIZE)
+        parse = functools.partial(parseChunk, taxa=self.taxa, dbs=self.dbs, objtypes=self.objtypes)
+        with multiprocessing.Pool(nprocs) as pool:
+            for part in pool.imap(parse, chunks):
+                for line in part[0]:
+                    self.parser.__parseheader__(line)
+                self.annotations.addPart(part)
+
     def __handleComment__(self, c):
         self.annotations.comments.append(c)
 
@@ -204,15 +738,30 @@ class AnnotationLoader(object):
         self.annotations.attributes[attr]=value
 
     def __handleAnnot__(self, annot):
+        if self.taxa and annot.getTaxon() not in self.taxa:
+            return
+        if self.dbs and annot.getDb() not in self.dbs:
+            return
+        if self.objtypes and annot.getObjType() not in self.objtypes:
+            return
         self.annotations.append(annot)
 
 #------------------------------------------------------------------
 
-__loader__ = AnnotationLoader()
-load = __loader__.loadFile
+def load(*args, **kwargs):
+    '''
+    Loads an annotation file (see AnnotationLoader.loadFile). Each call gets its own loader,
+    since loaders keep state, and loads may run in several threads at once.
+    '''
+    return AnnotationLoader().loadFile(*args, **kwargs)
 
 #------------------------------------------------------------------
 
 if __name__ == "__main__":
-    a = load(sys.argv[1])
+    import time
+    nprocs = len(sys.argv) > 2 and int(sys.argv[2]) or 1
+    budget = len(sys.argv) > 3 and int(float(sys.argv[3])*1024*1024) or None
+    t = time.time()
+    a = load(sys.argv[1], nprocs=nprocs, memoryBudget=budget)
+    print("%d annotations, %d objects, %d procs, %1.2f sec" % (len(a), len(a.id2dbobj), nprocs, time.time()-t))
 
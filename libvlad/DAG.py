@@ -38,6 +38,14 @@
 #    A given edge is represented twice: in the out-edges of the
 #    parent node, and in the in-edges of the child node. 
 #
+# Orderings:
+#    Many algorithms (closures, subgraph extraction, culling) only need to
+#    see children before parents, or the reverse. Rather than recursing,
+#    they can sweep over a topological ordering of the nodes. The DAG computes
+#    its topological order and node depths on demand and caches them in
+#    self.orderCache. Any structural change (adding/removing a node or edge)
+#    clears the cache.
+#
 
 import sys
 
@@ -46,6 +54,7 @@ import sys
 class DAG(object):
     def __init__(self):
         self.nodes = {}
+        self.orderCache = {}
 
     #----------------------------------------------------------
     # STRUCTURING METHODS
@@ -57,6 +66,7 @@ class DAG(object):
         return self
 
     def removeNode(self, n):
+        self.__invalidate__()
         for p in self.iterParents(n):
             self.__children__(p).pop(n)
         for c in self.iterChildren(n):
@@ -69,11 +79,13 @@ class DAG(object):
         self.addNode(child)
         if checkCycles and (parent == child or self.isDescendant(parent, child)):
             raise CycleError("Edge would create cycle. parent(%s) child(%s)"%(str(parent), str(child)))
+        self.__invalidate__()
         self.__children__(parent)[child] = edgeData
         self.__parents__(child)[parent] = edgeData
         return self
 
     def removeEdge(self, parent, child):
+        self.__invalidate__()
         self.__children__(parent).pop(child)
         self.__parents__(child).pop(parent)
         return self
@@ -84,8 +96,27 @@ class DAG(object):
             cln.nodes[n] = (parents.copy(), children.copy())
         return cln
 
+    # Returns a new DAG containing the given nodes (those that are in this 
+    # graph) and every edge between them. The subgraph is built in one pass 
+    # directly from the adjacency dicts; there are no cycle checks, since a 
+    # subgraph of a DAG is a DAG. The subgraph inherits its topological 
+    # order from this one.
+    def subgraph(self, nodes):
+        index = self.getTopologicalIndex()
+        keep = set([n for n in nodes if n in index])
+        order = sorted(keep, key=index.__getitem__)
+        sub = DAG()
+        for n in order:
+            parents, children = self.nodes[n]
+            sub.nodes[n] = (
+                dict([(p,d) for (p,d) in parents.items() if p in keep]),
+                dict([(c,d) for (c,d) in children.items() if c in keep]))
+        sub.orderCache[('topo', False)] = order
+        return sub
+
     def clear(self):
         self.nodes = {}
+        self.__invalidate__()
         return self
 
     #----------------------------------------------------------
@@ -165,6 +196,111 @@ class DAG(object):
             for n2,d in self.iterOutEdges(n):
                 yield n, n2, d
 
+    #----------------------------------------------------------
+    # ORDERING METHODS
+    #----------------------------------------------------------
+
+    # Returns a list of all nodes in topological order: every parent comes
+    # before all of its children. If reversed is True, every child comes
+    # before its parents. The list is cached until the DAG is modified;
+    # callers must not modify it.
+    def getTopologicalOrder(self, reversed=False):
+        key = ('topo', reversed)
+        order = self.orderCache.get(key, None)
+        if order is None:
+            if reversed:
+                order = self.getTopologicalOrder()[::-1]
+            else:
+                order = self.__toposort__()
+            self.orderCache[key] = order
+        return order
+
+    # Returns a dict mapping each node to its position in the (forward)
+    # topological order.
+    def getTopologicalIndex(self):
+        index = self.orderCache.get('index', None)
+        if index is None:
+            index = dict((n,i) for (i,n) in enumerate(self.getTopologicalOrder()))
+            self.orderCache['index'] = index
+        return index
+
+    # Returns a dict mapping each node to its depth, i.e., the length of the 
+    # longest path from any root to the node. Roots have depth 0.
+    def getDepths(self):
+        depths = self.orderCache.get('depth', None)
+        if depths is None:
+            depths = {}
+            for n in self.getTopologicalOrder():
+                d = 0
+                for p in self.iterParents(n):
+                    d = max(d, depths[p]+1)
+                depths[n] = d
+            self.orderCache['depth'] = depths
+        return depths
+
+    def getDepth(self, n):
+        return self.getDepths()[n]
+
+    # Returns the set of ancestors of n, including n itself. Ancestor sets
+    # are computed on demand (for n and whatever ancestors of n haven't been
+    # seen yet) and cached until the DAG is modified.
+    def getAncestors(self, n):
+        ancestors = self.orderCache.setdefault('ancestors', {})
+        if n not in ancestors:
+            for m in self.getSweepOrder([n], reversed=True)[::-1]:
+                if m not in ancestors:
+                    s = set([m])
+                    for p in self.iterParents(m):
+                        s |= ancestors[p]
+                    ancestors[m] = frozenset(s)
+        return ancestors[n]
+
+    # Returns the list of nodes reachable from startNodes (including the start
+    # nodes themselves) in sweep order: parents before children, or children
+    # before parents if reversed. Reachability follows child links, or parent
+    # links if reversed, and only crosses edges for which edgeFilt(p,c,d)
+    # is True (if given). If startNodes is None, all nodes are returned.
+    # If order is given, it is a topological (parents first) list of nodes 
+    # to which the sweep is confined, e.g., the nodes of a single namespace.
+    def getSweepOrder(self, startNodes=None, reversed=False, edgeFilt=None, order=None):
+        if startNodes is None:
+            if order is None:
+                return self.getTopologicalOrder(reversed)
+            return reversed and order[::-1] or order
+        iterEdges = self.iterOutEdges
+        if reversed:
+            iterEdges = self.iterInEdges
+        def cross(n, n2, d):
+            if edgeFilt is None:
+                return True
+            elif reversed:
+                return edgeFilt(n2, n, d)
+            else:
+                return edgeFilt(n, n2, d)
+        reached = set([n for n in startNodes if self.hasNode(n)])
+        if order is None:
+            # walk out from the start nodes, then sort whatever we reached
+            stack = list(reached)
+            while stack:
+                n = stack.pop()
+                for (n2,d) in iterEdges(n):
+                    if n2 not in reached and cross(n, n2, d):
+                        reached.add(n2)
+                        stack.append(n2)
+            index = self.getTopologicalIndex()
+            return sorted(reached, key=index.__getitem__, reverse=reversed)
+        # sweep over the given order, marking as we go
+        if reversed:
+            order = order[::-1]
+        swept = []
+        for n in order:
+            if n in reached:
+                swept.append(n)
+                for (n2,d) in iterEdges(n):
+                    if cross(n, n2, d):
+                        reached.add(n2)
+        return swept
+
     #
     # General purpose graph traversal method. A traversal is a procedure for
     # visiting all or parts of a DAG in a depth-first, recursive manner from a 
@@ -306,8 +442,35 @@ class DAG(object):
     #----------------------------------------------------------
 
     def __addnode__(self, n):
+        self.__invalidate__()
         self.nodes[n] = ({}, {})    # ({parents}, {children})
 
+    def __invalidate__(self):
+        if self.orderCache:
+            self.orderCache.clear()
+
+    # Kahn's algorithm. Raises CycleError if the graph has a cycle (which can
+    # only happen if edges were added with checkCycles=False).
+    def __toposort__(self):
+        nparents = {}
+        order = []
+        for n,(parents,children) in self.nodes.items():
+            if len(parents) == 0:
+                order.append(n)
+            else:
+                nparents[n] = len(parents)
+        i = 0
+        while i < len(order):
+            for c in self.__children__(order[i]):
+                k = nparents[c] - 1
+                if k == 0:
+                    order.append(c)
+                nparents[c] = k
+            i += 1
+        if len(order) != len(self.nodes):
+            raise CycleError("Graph contains a cycle. Cannot compute topological order.")
+        return order
+
     def __parents__(self, child):
         return self.nodes[child][0]
 
@@ -371,36 +534,63 @@ class SimplePrinter(Traversal):
 #-------------------------------------------------------
 
 class Closure(Traversal):
+    '''
+    Computes, for every node reachable from the start nodes, the set of
+    selected nodes at or below it (or at or above it, if reversed).
+    Implemented as a sweep over the DAG's cached topological order rather
+    than as a recursive traversal.
+    '''
     def __init__(self,nodeSelector=lambda n:True):
         self.closure = {}
         self.nodeSelector = nodeSelector
-    def beforeNode(self,dag,node,path):
-        s = set()
-        if self.nodeSelector(node):
-            s.add(node)
-        self.closure[node] = s
-    def afterEdge(self,dag,p,c,d,path):
-        if self.reversed:
-            self.closure[c] |= self.closure[p]
-        else:
-            self.closure[p] |= self.closure[c]
+    def go(self, dag, startNodes=None, reversed=False, allPaths=False):
+        self.dag = dag
+        self.startNodes = startNodes
+        self.reversed = reversed
+        self.allPaths = allPaths
+        iterNext = dag.iterChildren
+        if reversed:
+            iterNext = dag.iterParents
+        closure = {}
+        # sweep from the far end back toward the start nodes, so that
+        # each node's successors are finished before the node itself
+        for n in dag.getSweepOrder(startNodes, reversed)[::-1]:
+            s = set()
+            if self.nodeSelector(n):
+                s.add(n)
+            for n2 in iterNext(n):
+                s |= closure[n2]
+            closure[n] = s
+        self.closure = closure
+        return self.getResults()
     def getResults(self):
         return self.closure
 
 #-------------------------------------------------------
 
 class RedundantEdgeFinder(Traversal):
+    '''
+    Finds edges p->c for which there is also a longer path from p to c.
+    Returns a list of [p, c, edgeData].
+    '''
     def __init__(self):
         self.redges = []
         self.allPaths=True
-    def beforeNode(self, dag, node, path):
-        # scan the nodes along the path for edges to me.
-        maxi = len(path)-4 # stop scan two nodes back
-        for i,p in enumerate(path):
-            if i > maxi:
-                break
-            if i%2==0 and dag.hasEdge(p,node):
-                self.redges.append( [p,node,dag.getEdge(p,node)] )
+    def go(self, dag, startNodes=None, reversed=False, allPaths=True):
+        self.dag = dag
+        self.redges = []
+        # ancestors of each node (including the node itself)
+        ancs = Closure().go(dag, reversed=True)
+        for node in dag.getSweepOrder(startNodes):
+            parents = dag.getParents(node)
+            if len(parents) < 2:
+                continue
+            for p in parents:
+                for q in parents:
+                    if q != p and p in ancs[q]:
+                        self.redges.append( [p,node,dag.getEdge(p,node)] )
+                        break
+        return self.getResults()
     def getResults(self):
         return self.redges
 
@@ -436,18 +626,19 @@ class SubgraphExtracter(Traversal):
         # from the start nodes. If False, extraction only includes
         # the nodes given and any edges between them.
         self.inclusive = inclusive
-    def beforeTraverse(self, dag):
-        self.subgraph = DAG()
-        if not self.inclusive:
-            for n in self.startNodes:
-                if dag.hasNode(n):
-                    self.subgraph.addNode(n)
-    def beforeNode(self, dag, node, path):
+    def go(self, dag, startNodes=None, reversed=False, allPaths=False):
+        self.dag = dag
+        self.startNodes = startNodes
+        self.reversed = reversed
+        self.allPaths = allPaths
         if self.inclusive:
-            self.subgraph.addNode(node)
-    def beforeEdge(self, dag, p, c, d, path):
-        if self.inclusive or (self.subgraph.hasNode(p) and self.subgraph.hasNode(c)):
-            self.subgraph.addEdge(p,c,d)
+            nodes = dag.getSweepOrder(startNodes, reversed)
+        elif startNodes is None:
+            nodes = dag.getTopologicalOrder()
+        else:
+            nodes = startNodes
+        self.subgraph = dag.subgraph(nodes)
+        return self.getResults()
     def getResults(self):
         return self.subgraph
 
@@ -537,6 +728,11 @@ if __name__ == "__main__":
     printeval("list(d.iterLeaves())", env)
     printeval("d.getParents('b')", env)
     printeval("d.getChildren('b')", env)
+    printeval("d.getTopologicalOrder()", env)
+    printeval("d.getTopologicalOrder(reversed=True)", env)
+    printeval("d.getDepths()", env)
+    printeval("d.getSweepOrder(['b'], reversed=True)", env)
+    printeval("d.getAncestors('d')", env)
 
     #
     pr=SimplePrinter()
@@ -572,6 +768,9 @@ if __name__ == "__main__":
     sg = SubgraphExtracter().go(d, 'd', reversed=True)
     pr.go(sg)
     print()
+    print("Subgraph (a, c, y)")
+    pr.go(d.subgraph(['a','c','y']))
+    print()
     print("Clone:")
     d2 = d.clone()
     pr.go(d2)
@@ -0,0 +1,66 @@
+#
+# FileTools.py
+#
+# Opening Vlad's input files (ontologies, annotations, uploads).
+#
+# Input files may be plain, gzip-compressed, or zstd-compressed. The
+# compression is detected from the first few bytes of the file (not its name),
+# and the data is decompressed as it's read, in large chunks. There is no
+# need to keep an uncompressed copy on disk.
+#
+# zstd support requires the 'zstandard' module. If it's not installed,
+# opening a zstd-compressed file raises an error; everything else works.
+#
+
+import io
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#------------------------------------------------------------------
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Size of reads from the (compressed) file.
+BUFSIZE = 1024 * 1024
+
+#------------------------------------------------------------------
+
+def getCompression(fname):
+    '''
+    Returns "gzip", "zstd", or None, according to the file's magic number.
+    '''
+    fd = open(fname, 'rb')
+    magic = fd.read(4)
+    fd.close()
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    elif magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    else:
+        return None
+
+def openInput(fname, mode='rb'):
+    '''
+    Opens the named file for reading, decompressing on the fly if needed.
+    With mode 'rb' (the default) returns a binary file object. With mode 'r'
+    returns a text file object (utf-8).
+    '''
+    comp = getCompression(fname)
+    if comp == "gzip":
+        fd = io.BufferedReader(gzip.open(fname, 'rb'), BUFSIZE)
+    elif comp == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Cannot read zstd-compressed file (zstandard module not installed): " + fname)
+        dctx = zstandard.ZstdDecompressor()
+        reader = dctx.stream_reader(open(fname, 'rb'), read_size=BUFSIZE, closefd=True)
+        fd = io.BufferedReader(reader, BUFSIZE)
+    else:
+        fd = open(fname, 'rb', buffering=BUFSIZE)
+    if mode == 'r':
+        fd = io.TextIOWrapper(fd, encoding='utf-8')
+    return fd
@@ -0,0 +1,213 @@
+#
+# Gpad.py
+#
+# Loading annotations from a GPAD 2.0 (Gene Product Association Data) file
+# plus its companion GPI 2.0 (Gene Product Information) file.
+#
+# A GPAD line holds just the association (object, negation, relation, term,
+# reference, evidence, with, interacting taxon, date, assigned by, ...).
+# Everything about the object itself (symbol, name, synonyms, type, taxon)
+# is in the GPI, once per object. The GPI is read first into a dict keyed by
+# object id, and each GPAD line is joined to it as it is read. The result
+# is an ordinary AnnotationSet of GAF-style Annotations, so the rest of Vlad
+# doesn't know the difference.
+#
+# Notes:
+# - Object ids are the full GPAD/GPI ids (e.g. "UniProtKB:P12345", "MGI:97490").
+#   The local part (e.g. "P12345") is also accepted when resolving query sets.
+# - GPAD uses ECO terms for evidence; these are mapped to GO evidence
+#   codes (IDA, IEA, ...) so that evidence code exclusion works as usual.
+#   The mapping has built-in defaults, which can be extended with the GO
+#   consortium's gaf-eco-mapping.txt file.
+# - Negated ("NOT") associations get the qualifier "NOT"; the others get
+#   their relation (e.g. "RO:0002327") as qualifier.
+# - Files may be compressed (see FileTools).
+#
+
+import sys
+
+from . import Annotation
+from . import FileTools
+
+#------------------------------------------------------------------
+
+# GO evidence code for each ECO term: the default term for each code, plus
+# the other terms mapped to a code in gaf-eco-mapping.txt (mostly the several
+# automatic-assertion terms used for IEA). Use --ecoMapping to load the full,
+# current file.
+ECO2CODE = {
+    'ECO:0000269' : 'EXP',
+    'ECO:0000314' : 'IDA',
+    'ECO:0000353' : 'IPI',
+    'ECO:0000315' : 'IMP',
+    'ECO:0000316' : 'IGI',
+    'ECO:0000270' : 'IEP',
+    'ECO:0006056' : 'HTP',
+    'ECO:0007005' : 'HDA',
+    'ECO:0007001' : 'HMP',
+    'ECO:0007003' : 'HGI',
+    'ECO:0007007' : 'HEP',
+    'ECO:0000318' : 'IBA',
+    'ECO:0000319' : 'IBD',
+    'ECO:0000320' : 'IKR',
+    'ECO:0000321' : 'IRD',
+    'ECO:0000250' : 'ISS',
+    'ECO:0000266' : 'ISO',
+    'ECO:0000247' : 'ISA',
+    'ECO:0000255' : 'ISM',
+    'ECO:0000317' : 'IGC',
+    'ECO:0000245' : 'RCA',
+    'ECO:0000304' : 'TAS',
+    'ECO:0000303' : 'NAS',
+    'ECO:0000305' : 'IC',
+    'ECO:0000307' : 'ND',
+    'ECO:0000501' : 'IEA',
+    'ECO:0007669' : 'IEA',
+    'ECO:0000203' : 'IEA',
+    'ECO:0000256' : 'IEA',
+    'ECO:0000265' : 'IEA',
+    'ECO:0000249' : 'IEA',
+    'ECO:0000322' : 'IEA',
+    'ECO:0000323' : 'IEA',
+    'ECO:0000363' : 'IEA',
+    'ECO:0000366' : 'IEA',
+    }
+
+# Display names for common GPI object types.
+TYPELABELS = {
+    'SO:0000704'    : 'gene',
+    'PR:000000001'  : 'protein',
+    'SO:0000234'    : 'mRNA',
+    'SO:0000655'    : 'ncRNA',
+    'GO:0032991'    : 'protein_complex',
+    }
+
+def loadEcoMapping(file, eco2code=None):
+    '''
+    Reads an ECO to GO evidence code mapping file (gaf-eco-mapping.txt format:
+    ECO id, code, and GO_REF or "Default", TAB-delimited) and adds it to the
+    given mapping (default: a copy of ECO2CODE). Returns the mapping.
+    '''
+    if eco2code is None:
+        eco2code = dict(ECO2CODE)
+    fd = FileTools.openInput(file, 'r')
+    for line in fd:
+        if line.startswith('#'):
+            continue
+        tokens = line.strip().split('\t')
+        if len(tokens) >= 2:
+            eco2code.setdefault(tokens[0], tokens[1])
+    fd.close()
+    return eco2code
+
+#------------------------------------------------------------------
+
+def loadGpi(file):
+    '''
+    Reads a GPI 2.0 file into a dict mapping each object id to a tuple:
+    (db, id, symbol, name, synonyms, type, taxon), in GAF terms.
+    Repeated values (db, type, taxon) are shared.
+    '''
+    objects = {}
+    strings = {}
+    intern = strings.setdefault
+    fd = FileTools.openInput(file, 'r')
+    for line in fd:
+        if line.startswith('!'):
+            continue
+        t = line.rstrip('\r\n').split('\t')
+        if len(t) < 6:
+            continue
+        oid = t[0]
+        db = intern(oid.split(':',1)[0], oid.split(':',1)[0])
+        otype = TYPELABELS.get(t[4], t[4])
+        taxon = 'taxon:' + t[5].replace('NCBITaxon:','')
+        objects[oid] = (db, oid, t[1], t[2], t[3], intern(otype,otype), intern(taxon,taxon))
+    fd.close()
+    return objects
+
+#------------------------------------------------------------------
+
+class GpadParser(Annotation.AnnotationParser):
+    '''
+    Parser for GPAD 2.0 files. Same interface as AnnotationParser (header
+    lines go to the comment and attribute handlers), except that each
+    association line is joined to its object in the GPI index (see loadGpi)
+    and passed to annotHandler as a GAF-style Annotation.
+    Always parses serially.
+    '''
+    def __init__(self, annotHandler=None, attributeHandler=None, commentHandler=None):
+        Annotation.AnnotationParser.__init__(self, annotHandler, attributeHandler, commentHandler)
+        self.objects = {}
+        self.eco2code = ECO2CODE
+        self.unmapped = set()
+
+    def __parseannot__(self, line):
+        t = line.rstrip('\r\n').split('\t')
+        obj = self.objects.get(t[0], None)
+        if obj is None:
+            # not in the GPI. Use the id as the symbol.
+            (db, local) = t[0].split(':',1)
+            obj = self.objects[t[0]] = (db, t[0], local, '', '', '', '')
+        (db, oid, symbol, name, synonyms, otype, taxon) = obj
+        if t[1] == 'NOT':
+            qualifier = 'NOT'
+        else:
+            qualifier = t[2]
+        evidence = self.eco2code.get(t[5], None)
+        if evidence is None:
+            # keep the raw ECO id, but say so (once per id): evidence code
+            # filters (-x) won't match it.
+            evidence = t[5]
+            if evidence not in self.unmapped:
+                self.unmapped.add(evidence)
+                sys.stderr.write("Warning: no GO evidence code for %s; use --ecoMapping to map it.\n" % evidence)
+        return Annotation.Annotation([
+            db, oid, symbol, qualifier, t[3], t[4], evidence, t[6], '',
+            name, synonyms, otype, taxon, t[8].replace('-',''), t[9] ])
+
+#------------------------------------------------------------------
+
+class GpadLoader(Annotation.AnnotationLoader):
+    def __init__(self):
+        Annotation.AnnotationLoader.__init__(self)
+        self.parser = GpadParser(
+            annotHandler=self.__handleAnnot__,
+            attributeHandler=self.__handleAttribute__,
+            commentHandler=self.__handleComment__)
+
+    def loadFile(self, file, gpifile, config = None, memoryBudget = None, ecoMapping = None):
+        '''
+        Loads the GPAD file, joined to the GPI file. Returns an AnnotationSet
+        (see AnnotationLoader.loadFile for config and memoryBudget). If ecoMapping
+        is given, it is a gaf-eco-mapping.txt file that extends the built-in ECO
+        to evidence code mapping.
+        '''
+        self.parser.objects = loadGpi(gpifile)
+        if ecoMapping:
+            self.parser.eco2code = loadEcoMapping(ecoMapping)
+        else:
+            self.parser.eco2code = ECO2CODE
+        annots = Annotation.AnnotationLoader.loadFile(self, file, config, 1, memoryBudget)
+        # accept local ids as well
+        for oid in list(annots.id2dbobj.keys()):
+            annots.symbol2id.setdefault(oid.split(':',1)[-1], oid)
+        self.parser.objects = {}
+        return annots
+
+#------------------------------------------------------------------
+
+def load(*args, **kwargs):
+    '''
+    Loads a GPAD file (see GpadLoader.loadFile). Each call gets its own loader,
+    since loaders keep state, and loads may run in several threads at once.
+    '''
+    return GpadLoader().loadFile(*args, **kwargs)
+
+#------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import time
+    t = time.time()
+    a = load(sys.argv[1], sys.argv[2])
+    print("%d annotations, %d objects, %1.2f sec" % (len(a), len(a.id2dbobj), time.time()-t))
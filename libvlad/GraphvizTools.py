@@ -8,7 +8,13 @@
 import sys
 import os
 import time
+import re
 import types
+import shutil
+import hashlib
+import sqlite3
+import threading
+import subprocess
 from . import DAG
 import io
 
@@ -109,6 +115,7 @@ class DOTDAG(DAG.DAG):
         self.wrappedDag = dag
         if dag is not None:
             self.nodes = dag.nodes
+            self.orderCache = dag.orderCache
         self.objDotAttrs = {}  # maps nodes and edges to DOT attributes (a dict)
         self.currSubgraph = None
         if name:
@@ -236,6 +243,39 @@ class DOTDAG(DAG.DAG):
     def setSGAttr(self, which, name, value):
         self.currSubgraph.setAttr(which,name,value)
 
+    def setLayout(self, layout):
+        '''
+        Sets the positions of the nodes and edges (pos, etc.) from a layout of
+        the same graph, as written by dot -Tjson0. The graph can then be drawn
+        without being laid out again (see DOTRunner.runPositioned).
+        Returns False, and sets nothing, if the layout doesn't fit the graph.
+        '''
+        name2node = {}
+        for n in self.node2subgraph:
+            name2node[self.getNodeId(n)[1:-1]] = n
+        objs = layout.get('objects', [])[layout.get('_subgraph_cnt', 0):]
+        gvid2node = {}
+        nodeAttrs = []
+        for o in objs:
+            n = name2node.get(o.get('name'))
+            if n is None or 'pos' not in o:
+                return False
+            gvid2node[o['_gvid']] = n
+            nodeAttrs.append((n, dict([ (a,o[a]) for a in ('pos','width','height') if a in o ])))
+        edgeAttrs = []
+        for e in layout.get('edges', []):
+            edge = (gvid2node.get(e.get('tail')), gvid2node.get(e.get('head')))
+            if edge not in self.edge2subgraph or 'pos' not in e:
+                return False
+            edgeAttrs.append((edge, dict([ (a,e[a]) for a in ('pos','lp') if a in e ])))
+        if len(nodeAttrs) != len(name2node) or len(edgeAttrs) != len(self.edge2subgraph):
+            return False
+        for obj, attrs in nodeAttrs + edgeAttrs:
+            self.setObjAttrs(obj, attrs)
+        if 'bb' in layout:
+            self.rootSubgraph.setGraphAttr('bb', layout['bb'])
+        return True
+
     def __str__(self):
         b = io.StringIO()
         DOTWriter().write(self,b)
@@ -266,9 +306,11 @@ class DOTWriter(DAG.Traversal):
         self.writeHead(subgraph)
         for c in subgraph.children:
             self.writeSubgraph(c)
-        for n in subgraph.nodes:
+        # (in order by id, so the same graph is always written the same way)
+        getId = self.dag.getNodeId
+        for n in sorted(subgraph.nodes, key=getId):
             self.append( self.getNodeStr( self.dag, n ) )
-        for p,c in subgraph.edges:
+        for p,c in sorted(subgraph.edges, key=lambda e: (getId(e[0]), getId(e[1]))):
             self.append( self.getEdgeStr( self.dag, p, c ) )
         self.writeTail()
 
@@ -375,12 +417,218 @@ class DOTRunner(object):
         if homeDir:
             self.spawnEnv['HOME'] = homeDir
 
-    def run0(self, args = []):
-        os.spawnve(os.P_WAIT, self.executable, [self.executable]+args, self.spawnEnv)
-
-    def run(self, dotfile, outfile, format, extraArgs=[]):
+    def getFormats(self):
+        '''
+        Returns the set of output formats (-T) dot supports.
+        '''
+        st = os.stat(self.executable)
+        key = (self.executable, st.st_mtime_ns, st.st_size)
+        if key not in __formats__:
+            # (dot lists them in the error message for an unknown format)
+            p = subprocess.run([self.executable, "-T?"], env=self.spawnEnv,
+                stdin=subprocess.DEVNULL, capture_output=True, timeout=30)
+            msg = (p.stderr + p.stdout).decode('utf-8', 'replace')
+            fmts = msg.split("Use one of:", 1)[-1] if "Use one of:" in msg else ""
+            __formats__[key] = set([ f.split(':')[0] for f in fmts.split() ])
+        return __formats__[key]
+
+    def getVersion(self):
+        '''
+        Returns what dot -V says (e.g., "dot - graphviz version 2.43.0 ...").
+        '''
+        st = os.stat(self.executable)
+        key = (self.executable, st.st_mtime_ns, st.st_size)
+        if key not in __versions__:
+            p = subprocess.run([self.executable, "-V"], env=self.spawnEnv,
+                stdin=subprocess.DEVNULL, capture_output=True, timeout=30)
+            __versions__[key] = (p.stderr + p.stdout).decode('utf-8', 'replace').strip()
+        return __versions__[key]
+
+    def run0(self, args = [], timeout=None):
+        '''
+        Runs dot with args. If it runs longer than timeout seconds, dot is
+        killed and subprocess.TimeoutExpired is raised. If it fails, raises
+        subprocess.CalledProcessError (with dot's messages as its stderr).
+        '''
+        p = subprocess.run([self.executable]+args, env=self.spawnEnv, timeout=timeout,
+            stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args, stderr=p.stderr)
+        if p.stderr:
+            # warnings
+            sys.stderr.write(p.stderr.decode('utf-8', 'replace'))
+
+    def run(self, dotfile, outfile, format, extraArgs=[], timeout=None):
         args = [ "-o%s"%outfile, "-T%s"%format ] + extraArgs + [dotfile]
-        self.run0(args)
+        self.run0(args, timeout)
+
+    def runMulti(self, dotfile, outputs, extraArgs=[], timeout=None):
+        '''
+        Lays out dotfile once, and writes it in each format.
+        Outputs is a list of (format,outfile) pairs.
+        '''
+        args = []
+        for format, outfile in outputs:
+            args += [ "-T%s"%format, "-o%s"%outfile ]
+        self.run0(args + extraArgs + [dotfile], timeout)
+
+    def runPositioned(self, layoutfile, outputs, extraArgs=[], timeout=None):
+        '''
+        Like runMulti, for a file that has already been laid out (i.e., the
+        output of -Tdot). Node positions and edge splines are used as is;
+        the layout is not computed again.
+        '''
+        self.runMulti(layoutfile, outputs, ["-Kneato", "-n2"] + extraArgs, timeout)
+
+__versions__ = {}         # (executable, mtime, size) -> version string
+__formats__ = {}          # (executable, mtime, size) -> set of formats
+
+# Attributes that only color the drawing, and don't affect the layout.
+# (Also matches color attributes in HTML labels, e.g., BGCOLOR.)
+STYLERE = re.compile(rb'\b(?:bg|fill|font|pen)?color\s*=\s*"[^"]*"', re.I)
+
+def getLayoutText(dottext):
+    '''
+    Returns dottext (bytes) without the attributes that don't affect the
+    layout. Graphs with the same layout text have the same layout.
+    '''
+    return STYLERE.sub(b'', dottext)
+
+#------------------------------------------------------------------
+
+class RenderCache(object):
+    '''
+    Files generated by dot, by a key that hashes everything that determines
+    their contents (see makeKey), so a graph that has been drawn before
+    needn't be drawn again. Files are hard linked into and out of the cache
+    (or copied, where they can't be), so files in the cache must never be
+    modified in place. Each file's size and last use are kept in an index
+    (an SQLite database in dir). When the cache holds more than maxsize
+    bytes, the least recently used files are removed.
+    '''
+    INDEXFILE = "index.sqlite"
+
+    def __init__(self, dir, maxsize):
+        self.dir = dir
+        self.maxsize = maxsize
+        self.db = None
+        self.lock = threading.Lock()   # (graphs are drawn by several threads)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def getIndex(self):
+        '''
+        Returns the index (opening it if need be). The first time, files
+        already in the cache are entered in it.
+        '''
+        if self.db is None:
+            db = sqlite3.connect(os.path.join(self.dir, self.INDEXFILE), timeout=30,
+                isolation_level=None, check_same_thread=False)
+            try:
+                db.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
+                pass
+            new = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'files'").fetchone() is None
+            db.execute("CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, size INTEGER NOT NULL, lastused REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS files_lastused ON files (lastused)")
+            if new:
+                for sdRoot, sdSubdirs, sdFiles in os.walk(self.dir):
+                    for f in sdFiles:
+                        path = os.path.join(sdRoot, f)
+                        if sdRoot != self.dir and path == self.getPath(f):
+                            st = os.stat(path)
+                            db.execute("INSERT OR IGNORE INTO files (key, size, lastused) VALUES (?, ?, ?)",
+                                (f, st.st_size, st.st_mtime))
+            self.db = db
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def makeKey(self, dottext, version, format, args=[]):
+        '''
+        Returns the key for the format output of dot (the given version) run
+        with args over dottext (bytes).
+        '''
+        h = hashlib.sha256()
+        for part in [version, format] + list(args):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        h.update(dottext)
+        return h.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.dir, key[:2], key)
+
+    def linkOrCopy(self, src, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def use(self, keys):
+        with self.lock:
+            self.getIndex().executemany("UPDATE files SET lastused = ? WHERE key = ?",
+                [ (time.time(), k) for k in keys ])
+
+    def getFile(self, key):
+        '''
+        Returns the path of the cached file for key, or None.
+        '''
+        path = self.getPath(key)
+        if not os.path.exists(path):
+            return None
+        self.use([key])
+        return path
+
+    def fetch(self, key2file):
+        '''
+        Key2file maps keys to the files that should get their contents. If
+        every key is in the cache, links them all and returns True. Otherwise
+        returns False.
+        '''
+        paths = [ (self.getPath(k), f) for k,f in key2file.items() ]
+        if not all([ os.path.exists(path) for path, f in paths ]):
+            return False
+        try:
+            for path, f in paths:
+                self.linkOrCopy(path, f)
+        except OSError:
+            return False
+        self.use(key2file.keys())
+        return True
+
+    def add(self, key, file):
+        path = self.getPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tpath = path + ".tmp.%d.%d" % (os.getpid(), threading.get_ident())
+        self.linkOrCopy(file, tpath)
+        os.replace(tpath, path)
+        with self.lock:
+            self.getIndex().execute("INSERT OR REPLACE INTO files (key, size, lastused) VALUES (?, ?, ?)",
+                (key, os.path.getsize(path), time.time()))
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the rest fit in maxsize.
+        '''
+        with self.lock:
+            db = self.getIndex()
+            total = db.execute("SELECT total(size) FROM files").fetchone()[0]
+            while total > self.maxsize:
+                row = db.execute("SELECT key, size FROM files ORDER BY lastused LIMIT 1").fetchone()
+                if row is None:
+                    break
+                try:
+                    os.remove(self.getPath(row[0]))
+                except OSError:
+                    pass
+                db.execute("DELETE FROM files WHERE key = ?", (row[0],))
+                total -= row[1]
 
 #------------------------------------------------------------------
 
@@ -0,0 +1,221 @@
+#
+# Jobs.py
+#
+# Asynchronous Vlad runs. Instead of running Vlad inside the HTTP request,
+# the web front end (www/vlad.py, cmd=submit) records a job and returns its id
+# right away; the browser then polls for its status (cmd=status), which
+# reports the phase and percent complete, and finally the same results
+# message a synchronous run prints.
+#
+# Jobs are kept on local disk, one directory per job, under the "jobs"
+# subdirectory of the output directory:
+#    <outputdir>/jobs/<jobid>/job.json     the job's state (see below)
+#    <outputdir>/jobs/<jobid>/...          the job's uploaded files
+# job.json is always replaced as a whole (write temp + rename). Its fields:
+#    id, state ("queued", "running", "done", "error"), phase, percent,
+#    args (the Vlad command line), submitted, started, finished (times),
+#    output (when done: the results message html), error (when failed)
+# Job directories are entered in the output directory's RunManifest, and
+# expire along with the run directories (see maxAge).
+#
+# Jobs are run by a JobRunner, at most --workers at a time, fed from the
+# queued jobs on disk. The Vlad server (bin/vlad-server.py --workers) runs
+# one. Each job gets a fresh process, forked from the server when the job
+# starts, so it sees the server's data as it is then (including any reloads
+# since the previous job). Because the state is on disk, jobs survive
+# restarts: jobs that were running when the runner stopped are queued again
+# when it starts.
+#
+#-------------------------------------------------------------------
+
+import sys
+import os
+import io
+import re
+import json
+import time
+import secrets
+import threading
+import traceback
+import multiprocessing
+
+#-------------------------------------------------------------------
+
+class JobStore(object):
+    JOBFILE = "job.json"
+    IDRE = re.compile(r'^[0-9a-f]{16}$')
+
+    def __init__(self, dir, maxage=None):
+        self.dir = dir
+        self.maxage = maxage
+        os.makedirs(self.dir, exist_ok=True)
+
+    def jobDir(self, id):
+        if not self.IDRE.match(id or ''):
+            raise ValueError("Bad job id: %s" % id)
+        return os.path.join(self.dir, id)
+
+    def newJob(self):
+        '''
+        Creates a new (empty) job directory. Returns the job id.
+        '''
+        while True:
+            id = secrets.token_hex(8)
+            try:
+                os.mkdir(self.jobDir(id))
+                break
+            except FileExistsError:
+                pass
+        if self.maxage is not None:
+            from .Vlad import RunManifest
+            m = RunManifest(os.path.dirname(self.dir))
+            m.add(self.jobDir(id), time.time() + self.maxage)
+            m.close()
+        return id
+
+    def exists(self, id):
+        return os.path.exists(os.path.join(self.jobDir(id), self.JOBFILE))
+
+    def read(self, id):
+        fd = open(os.path.join(self.jobDir(id), self.JOBFILE), 'r')
+        job = json.load(fd)
+        fd.close()
+        return job
+
+    def write(self, job):
+        jfile = os.path.join(self.jobDir(job['id']), self.JOBFILE)
+        tfile = jfile + ".tmp.%d" % os.getpid()
+        fd = open(tfile, 'w')
+        json.dump(job, fd)
+        fd.close()
+        os.replace(tfile, jfile)
+
+    def update(self, id, **kw):
+        job = self.read(id)
+        job.update(kw)
+        self.write(job)
+        return job
+
+    def submit(self, id, args):
+        '''
+        Queues job id to run Vlad with args.
+        '''
+        job = {
+            'id'        : id,
+            'state'     : 'queued',
+            'phase'     : 'queued',
+            'percent'   : 0,
+            'args'      : args,
+            'submitted' : time.time(),
+            'started'   : None,
+            'finished'  : None,
+            'output'    : None,
+            'error'     : None,
+            }
+        self.write(job)
+        return job
+
+    def getJobs(self, state=None):
+        '''
+        Returns the jobs (in the given state), oldest first.
+        '''
+        jobs = []
+        for id in os.listdir(self.dir):
+            if self.IDRE.match(id) and self.exists(id):
+                try:
+                    job = self.read(id)
+                except (OSError, ValueError):
+                    continue
+                if state is None or job['state'] == state:
+                    jobs.append(job)
+        jobs.sort(key=lambda j: j['submitted'])
+        return jobs
+
+    def requeue(self):
+        '''
+        Queues again any jobs left running (i.e., by a runner that died).
+        '''
+        for job in self.getJobs('running'):
+            self.update(job['id'], state='queued', phase='queued', percent=0)
+
+#-------------------------------------------------------------------
+
+def getJobStore(cfgfile):
+    '''
+    Returns the JobStore for the output directory named in the config file.
+    '''
+    from .Vlad import Vlad
+    cp = Vlad().cfgParser
+    cp.read(cfgfile)
+    maxage = cp.getfloat('VLAD', 'maxage', fallback=1)*24*3600
+    return JobStore(os.path.join(cp.get('VLAD', 'outputdir'), 'jobs'), maxage)
+
+def runJob(store, id, cls):
+    '''
+    Runs job id with an instance of cls (VladCGI or a subclass), recording
+    progress and the outcome in the store.
+    '''
+    job = store.update(id, state='running', phase='starting', percent=0, started=time.time())
+    v = cls()
+    v.progressHandler = lambda phase, percent: store.update(id, phase=phase, percent=percent)
+    out = io.StringIO()
+    try:
+        v.go(job['args'], out)
+        store.update(id, state='done', phase='done', percent=100,
+            finished=time.time(), output=out.getvalue())
+    except (Exception, SystemExit) as e:
+        store.update(id, state='error', phase='error', finished=time.time(),
+            error='%s: %s' % (e.__class__.__name__, e), output=out.getvalue())
+        sys.stderr.write(traceback.format_exc())
+    return id
+
+#-------------------------------------------------------------------
+
+class JobRunner(object):
+    '''
+    Runs queued jobs from the store, at most nworkers at a time, each in a
+    process of its own. Call start() to run in a background thread.
+    '''
+    def __init__(self, store, cls, nworkers=2, interval=1.0):
+        self.store = store
+        self.cls = cls
+        self.nworkers = nworkers
+        self.interval = interval
+        self.running = {}       # job id -> process
+
+    def start(self):
+        self.store.requeue()
+        t = threading.Thread(target=self.loop)
+        t.daemon = True
+        t.start()
+        return t
+
+    def loop(self):
+        if 'fork' in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context('fork')
+        else:
+            ctx = multiprocessing.get_context()
+        while True:
+            try:
+                self.reap()
+                if len(self.running) < self.nworkers:
+                    for job in self.store.getJobs('queued')[:self.nworkers - len(self.running)]:
+                        id = job['id']
+                        self.store.update(id, state='running', phase='starting')
+                        # (not a daemon: jobs can have their own pools, e.g., for --aSets)
+                        p = ctx.Process(target=runJob, args=(self.store, id, self.cls))
+                        p.start()
+                        self.running[id] = p
+            except Exception:
+                sys.stderr.write(traceback.format_exc())
+            time.sleep(self.interval)
+
+    def reap(self):
+        for id, p in list(self.running.items()):
+            if not p.is_alive():
+                p.join()
+                del self.running[id]
+                if p.exitcode != 0 and self.store.read(id)['state'] == 'running':
+                    # the process itself failed (e.g., was killed)
+                    self.store.update(id, state='error', phase='error',
+                        finished=time.time(), error='Job process exited with status %s' % p.exitcode)
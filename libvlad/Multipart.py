@@ -0,0 +1,256 @@
+#
+# Multipart.py
+#
+# Parsing of HTML form submissions (multipart/form-data or urlencoded), for
+# the web front end (www/vlad.py), under CGI or WSGI. Replaces cgi.FieldStorage
+# (the cgi module is gone as of Python 3.13).
+#
+# The request body is read in chunks and never held in memory as a whole.
+# Uploaded files are streamed straight to temp files, and their SHA-256
+# hashes are computed on the way. Ordinary fields are kept in memory.
+#
+# Form provides the subset of the FieldStorage interface that Vlad uses:
+#    name in form
+#    form[name]                 -> the (first) Field with that name
+#    form.getvalue(name, dflt)  -> value of the (first) field
+#    form.getlist(name)         -> values of all fields with that name
+# A Field has: name, value (str; for uploads, the contents as bytes),
+# filename (None unless an upload), and for uploads, path, size, sha256.
+# Call form.cleanup() to remove the temp files. (To keep an upload, move the
+# file elsewhere first.)
+#
+
+import os
+import hashlib
+import tempfile
+import urllib.parse
+import email.parser
+import email.message
+
+#------------------------------------------------------------------
+
+BUFSIZE = 64*1024
+
+# Max size of a non-file field, and of a part's headers.
+MAXFIELDSIZE = 32*1024*1024
+MAXHEADERSIZE = 16*1024
+
+#------------------------------------------------------------------
+
+class Field(object):
+    def __init__(self, name, value=None, filename=None, path=None, size=0, sha256=None):
+        self.name = name
+        self._value = value
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+    @property
+    def value(self):
+        if self.path is not None:
+            fd = open(self.path, 'rb')
+            v = fd.read()
+            fd.close()
+            return v
+        return self._value
+
+#------------------------------------------------------------------
+
+class Form(object):
+    def __init__(self):
+        self.fields = []
+        self.name2fields = {}
+        self.tempfiles = []
+
+    def add(self, field):
+        self.fields.append(field)
+        self.name2fields.setdefault(field.name, []).append(field)
+        if field.path is not None:
+            self.tempfiles.append(field.path)
+
+    def __contains__(self, name):
+        return name in self.name2fields
+
+    def __getitem__(self, name):
+        return self.name2fields[name][0]
+
+    def keys(self):
+        return list(self.name2fields.keys())
+
+    def getvalue(self, name, default=None):
+        if name in self.name2fields:
+            return self.name2fields[name][0].value
+        return default
+
+    def getlist(self, name):
+        return [ f.value for f in self.name2fields.get(name, []) ]
+
+    def getUploads(self):
+        return [ f for f in self.fields if f.path is not None ]
+
+    def cleanup(self):
+        for path in self.tempfiles:
+            if os.path.exists(path):
+                os.remove(path)
+
+#------------------------------------------------------------------
+
+class MultipartParser(object):
+    '''
+    Streaming parser for a multipart/form-data body.
+    '''
+    def __init__(self, fp, boundary, length, tmpdir=None):
+        self.fp = fp
+        self.remaining = length
+        self.tmpdir = tmpdir
+        # The first delimiter is not preceded by CRLF. Pretend it is.
+        self.buf = b'\r\n'
+        self.delim = b'\r\n--' + boundary
+
+    def read(self):
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return b''
+            data = self.fp.read(min(BUFSIZE, self.remaining))
+            self.remaining -= len(data)
+        else:
+            data = self.fp.read(BUFSIZE)
+        return data
+
+    def fill(self, n):
+        while len(self.buf) < n:
+            data = self.read()
+            if not data:
+                return False
+            self.buf += data
+        return True
+
+    def readUntil(self, delim, sink):
+        '''
+        Passes data to sink up to the next occurrence of delim, and consumes
+        the delim. Returns False if the body ends first.
+        '''
+        keep = len(delim) - 1
+        while True:
+            i = self.buf.find(delim)
+            if i >= 0:
+                sink(self.buf[:i])
+                self.buf = self.buf[i+len(delim):]
+                return True
+            if len(self.buf) > keep:
+                sink(self.buf[:-keep])
+                self.buf = self.buf[-keep:]
+            data = self.read()
+            if not data:
+                sink(self.buf)
+                self.buf = b''
+                return False
+            self.buf += data
+
+    def parse(self, form):
+        # skip the preamble
+        if not self.readUntil(self.delim, lambda d: None):
+            raise ValueError("Malformed multipart body: no boundary.")
+        while True:
+            if not self.fill(2):
+                raise ValueError("Malformed multipart body: truncated.")
+            if self.buf.startswith(b'--'):
+                break
+            # headers
+            hparts = []
+            def collectHeaders(d):
+                hparts.append(d)
+                if sum(map(len, hparts)) > MAXHEADERSIZE:
+                    raise ValueError("Multipart headers too large.")
+            if not self.readUntil(b'\r\n\r\n', collectHeaders):
+                raise ValueError("Malformed multipart body: truncated headers.")
+            headers = email.parser.HeaderParser().parsestr(
+                b''.join(hparts).decode('utf-8', 'replace').lstrip('\r\n'))
+            name = headers.get_param('name', header='content-disposition')
+            filename = headers.get_filename()
+            if filename is not None:
+                field = self.parseFile(name, filename)
+            else:
+                field = self.parseValue(name)
+            if name is not None:
+                form.add(field)
+            elif field.path is not None:
+                os.remove(field.path)
+        # drain the epilogue
+        while self.read():
+            pass
+
+    def parseValue(self, name):
+        parts = []
+        def collect(d):
+            parts.append(d)
+            if sum(map(len, parts)) > MAXFIELDSIZE:
+                raise ValueError("Form field too large: %s" % name)
+        if not self.readUntil(self.delim, collect):
+            raise ValueError("Malformed multipart body: truncated field.")
+        return Field(name, b''.join(parts).decode('utf-8', 'replace'))
+
+    def parseFile(self, name, filename):
+        if not filename:
+            # file input left empty
+            if not self.readUntil(self.delim, lambda d: None):
+                raise ValueError("Malformed multipart body: truncated field.")
+            return Field(name, b'', filename='')
+        fd, path = tempfile.mkstemp(dir=self.tmpdir)
+        fp = os.fdopen(fd, 'wb')
+        h = hashlib.sha256()
+        size = [0]
+        def write(d):
+            if d:
+                h.update(d)
+                fp.write(d)
+                size[0] += len(d)
+        try:
+            ok = self.readUntil(self.delim, write)
+        finally:
+            fp.close()
+        if not ok:
+            os.remove(path)
+            raise ValueError("Malformed multipart body: truncated file.")
+        return Field(name, filename=os.path.basename(filename.replace('\\','/')),
+            path=path, size=size[0], sha256=h.hexdigest())
+
+#------------------------------------------------------------------
+
+def parseForm(environ, fp=None, tmpdir=None):
+    '''
+    Parses the form submitted in a CGI or WSGI request. Environ is os.environ
+    (CGI) or the WSGI environ; fp is the request body (default: wsgi.input).
+    Uploaded files are written to tmpdir. Returns a Form.
+    '''
+    form = Form()
+    for n,v in urllib.parse.parse_qsl(environ.get('QUERY_STRING', ''), keep_blank_values=True):
+        form.add(Field(n, v))
+    if environ.get('REQUEST_METHOD', 'GET').upper() != 'POST':
+        return form
+    if fp is None:
+        fp = environ['wsgi.input']
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    ctype = email.message.Message()
+    ctype['content-type'] = environ.get('CONTENT_TYPE', '')
+    mtype = ctype.get_content_type()
+    if mtype == 'multipart/form-data':
+        boundary = ctype.get_param('boundary')
+        if not boundary:
+            raise ValueError("No multipart boundary.")
+        try:
+            MultipartParser(fp, boundary.encode('latin-1'), length, tmpdir).parse(form)
+        except:
+            form.cleanup()
+            raise
+    elif mtype == 'application/x-www-form-urlencoded':
+        if length > MAXFIELDSIZE:
+            raise ValueError("Form too large.")
+        body = fp.read(length).decode('latin-1')
+        for n,v in urllib.parse.parse_qsl(body, keep_blank_values=True, encoding='utf-8'):
+            form.add(Field(n, v))
+    return form
@@ -5,6 +5,7 @@
 #       OboOntology
 #       OboTerm
 #       OboParser
+#       OboStreamParser
 #       OboLoader
 #
 # Feb 23, 2011
@@ -17,10 +18,13 @@
 #------------------------------------
 
 import sys
+import io
 import re
 import string
 import types
+import time
 from . import DAG
+from . import FileTools
 
 #------------------------------------
 #
@@ -99,10 +103,25 @@ class OboOntology(DAG.DAG):
 
     def addRelationship(self, child, rel, parent):
         rel = self.relationshipTypes.setdefault(rel,rel)
-        child = self.getTerm(child)
-        parent = self.getTerm(parent)
+        if type(child) is str:
+            child = self.getTerm(child)
+        if type(parent) is str:
+            parent = self.getTerm(parent)
         self.addEdge(parent, child, rel, checkCycles=False)
 
+    def getNamespaceOrder(self, ns, reversed=False):
+        '''
+        Returns the terms of the given namespace in topological order
+        (parents first, or children first if reversed). Cached along with 
+        the DAG's other orderings.
+        '''
+        key = ('namespace', ns, reversed)
+        order = self.orderCache.get(key, None)
+        if order is None:
+            order = [t for t in self.getTopologicalOrder(reversed) if t.namespace == ns]
+            self.orderCache[key] = order
+        return order
+
     def getRoot(self, ns=None):
         if len(self.nsRoots) == 0:
             self.cacheRoots()
@@ -185,7 +204,7 @@ class OboParser(object):
 
     def parseFile(self, file):
         if type(file) is str:
-            self.fd = open(file, 'r')
+            self.fd = FileTools.openInput(file, 'r')
         else:
             self.fd = file
         self.__go__()
@@ -222,6 +241,137 @@ class OboParser(object):
                 self.__addToStanza__(line)
         self.__finishStanza__()
 
+#-----------------------------------
+#
+# OboStreamParser
+#
+# Fast parser for the minimal case, where all we want from the file is the
+# bare graph: term ids, names, namespaces, obsolete flags, and is_a/relationship
+# edges. The file is read as bytes in large blocks, and a single regular
+# expression picks out just the lines having those tags. All other lines 
+# (defs, synonyms, xrefs, comments, ...) are skipped inside the regex
+# engine without ever being turned into strings. Instead of building a stanza 
+# dict, each [Term] is passed straight to the term processing function:
+#
+#     termProcessor(id, name, namespace, is_obsolete, isas, relationships)
+#
+# where namespace is None if the term doesn't specify one, isas is a list
+# of (parentId, parentName) pairs, and relationships is a list of 
+# (relationshipType, parentId, parentName) triples. E.g., for the example
+# stanza above:
+#
+#     termProcessor("GO:0000001", "mitochondrion inheritance", 
+#         "biological_process", False,
+#         [("GO:0048308", "organelle inheritance"),
+#          ("GO:0048311", "mitochondrion distribution")], [])
+#
+# The header (everything before the first stanza) is small, and is handed to
+# an OboParser so that the header processing function sees the usual dict.
+#
+
+class OboStreamParser(object):
+
+    BLOCKSIZE = 4 * 1024 * 1024
+
+    TAGRE = re.compile(
+        rb'\n(?:\[([^\]\n]*)\]'
+        rb'|(id|name|namespace|is_a|relationship|is_obsolete):[ \t]*([^\n]*))')
+
+    def __init__(self, termProcessor, headerProcessor=None):
+        self.termProcessor = termProcessor
+        self.headerProcessor = headerProcessor
+        self.count = 0
+
+    # Returns True iff file is something this parser can read: a file name,
+    # or a file object opened in binary mode.
+    @staticmethod
+    def canParse(file):
+        return type(file) is str or isinstance(file, (io.RawIOBase, io.BufferedIOBase))
+
+    def parseFile(self, file):
+        if type(file) is str:
+            fd = FileTools.openInput(file)
+        else:
+            fd = file
+        try:
+            self.__go__(fd)
+        finally:
+            if type(file) is str:
+                fd.close()
+
+    def __go__(self, fd):
+        self.count = 0
+        self.stanzaType = None
+        # read until we have the whole header
+        buf = b'\n' + fd.read(self.BLOCKSIZE)
+        while True:
+            i = buf.find(b'\n[')
+            if i >= 0:
+                break
+            block = fd.read(self.BLOCKSIZE)
+            if not block:
+                i = len(buf)
+                break
+            buf += block
+        if self.headerProcessor and i > 1:
+            OboParser(self.headerProcessor).parseFile(
+                io.StringIO(buf[1:i].decode('utf-8', 'replace')))
+        buf = buf[i:]
+        # now the stanzas, one block of complete lines at a time
+        while True:
+            block = fd.read(self.BLOCKSIZE)
+            if not block:
+                self.__scan__(buf)
+                break
+            buf += block
+            j = buf.rfind(b'\n')
+            self.__scan__(buf[:j])
+            buf = buf[j:]
+        self.__finishStanza__()
+
+    def __scan__(self, text):
+        for (stype, tag, val) in self.TAGRE.findall(text):
+            if not tag:
+                self.__finishStanza__()
+                self.stanzaType = stype
+                self.id = None
+                self.name = ''
+                self.namespace = None
+                self.is_obsolete = False
+                self.isas = []
+                self.relationships = []
+            elif self.stanzaType != b'Term':
+                continue
+            elif tag == b'is_a':
+                pts = val.split(b'!', 1)
+                self.isas.append( (
+                    pts[0].strip().decode('utf-8'),
+                    len(pts) == 2 and pts[1].strip().decode('utf-8') or '') )
+            elif tag == b'relationship':
+                pts = val.split(b'!', 1)
+                tokens = pts[0].split()
+                if len(pts) != 2 or len(tokens) != 2:
+                    continue
+                self.relationships.append( (
+                    tokens[0].decode('utf-8'), 
+                    tokens[1].decode('utf-8'),
+                    pts[1].strip().decode('utf-8')) )
+            elif tag == b'id':
+                self.id = val.strip().decode('utf-8')
+            elif tag == b'name':
+                self.name = val.strip().decode('utf-8')
+            elif tag == b'namespace':
+                self.namespace = val.strip().decode('utf-8')
+            elif tag == b'is_obsolete':
+                self.is_obsolete = (val.strip() == b'true')
+
+    def __finishStanza__(self):
+        if self.stanzaType == b'Term' and self.id is not None:
+            self.count += 1
+            self.termProcessor(self.id, self.name, self.namespace,
+                self.is_obsolete, self.isas, self.relationships)
+        self.stanzaType = None
+
 #-----------------------------------
 #
 # An OboLoader parses an OBO file and returns the corresponding DAG.
@@ -235,6 +385,9 @@ class OboLoader(object):
         self.loadMinimal = False
         self.defaultNamespace = "ontology." + str(id(self))
         self.nodeType = None
+        self.pendingEdges = []
+        # if True, use an OboStreamParser when loading minimally.
+        self.streamMinimal = True
 
     def loadFile(self, file, cullObsolete=False, loadMinimal=False, config=None, nodeType=OboTerm):
         self.cullObsolete = cullObsolete
@@ -242,16 +395,27 @@ class OboLoader(object):
         self.nodeType = nodeType
         self.ontology = OboOntology(nodeType=self.nodeType)
         self.ontology.config = config
-        self.parser.parseFile(file)
+        self.pendingEdges = []
+        if self.loadMinimal and self.streamMinimal and OboStreamParser.canParse(file):
+            OboStreamParser(self.processMinimalTerm, self.processStanza).parseFile(file)
+        else:
+            self.parser.parseFile(file)
+        self.addPendingEdges()
+        return self.ontology
 
-        # Prune out any edges that cross namespaces.
+    def addPendingEdges(self):
+        # Edges are held back until the whole file has been read, so that
+        # the namespace of every term is known. Edges that would cross 
+        # namespaces are never added.
         # (GO is going to start including edges between process 
         # and function at some point).
-        def efilt(p,c,d):
-            return p.namespace is not c.namespace
-        DAG.SimplePruner(edgeFilt=efilt).go(self.ontology)
-
-        return self.ontology
+        id2term = self.ontology.id2term
+        for (id, rel, id2) in self.pendingEdges:
+            child = id2term[id]
+            parent = id2term[id2]
+            if parent.namespace is child.namespace:
+                self.ontology.addRelationship(child, rel, parent)
+        self.pendingEdges = []
 
     def processStanza(self, stanza):
         stype = stanza["__type__"][0]
@@ -280,7 +444,7 @@ class OboLoader(object):
         for isa in stanza.get("is_a", []):
             (id2,name2) = list(map(str.strip,isa.split("!",1)))
             self.ontology.addTerm(id2, name2)
-            self.ontology.addRelationship(id, "is_a", id2)
+            self.pendingEdges.append( (id, "is_a", id2) )
         for reln in stanza.get("relationship", []):
             tokens = reln.split("!",1)
             if len(tokens) != 2:
@@ -292,18 +456,56 @@ class OboLoader(object):
             (rel,id2) = tokens
             if rel == "part_of" or "regulates" in rel:
                 self.ontology.addTerm(id2, name2)
-                self.ontology.addRelationship(id, rel, id2)
+                self.pendingEdges.append( (id, rel, id2) )
         if self.loadMinimal:
             return
         for attr, val in stanza.items():
             if attr not in ['id','name','namespace','relationship','is_a']:
                 self.ontology.setTermAttribute(t, attr, val)
 
+    def processMinimalTerm(self, id, name, namespace, is_obsolete, isas, relationships):
+        # Term processor for an OboStreamParser. Same as processTerm, minus
+        # all the splitting.
+        if is_obsolete and self.cullObsolete:
+            return
+        t = self.ontology.addTerm(id, name)
+        t.name = name
+        t.is_obsolete = is_obsolete
+        self.ontology.setTermAttribute(t,'namespace',namespace or self.defaultNamespace)
+        for (id2,name2) in isas:
+            self.ontology.addTerm(id2, name2)
+            self.pendingEdges.append( (id, "is_a", id2) )
+        for (rel,id2,name2) in relationships:
+            if rel == "part_of" or "regulates" in rel:
+                self.ontology.addTerm(id2, name2)
+                self.pendingEdges.append( (id, rel, id2) )
+
 #------------------------------------
-__loader__ = OboLoader( )
-load = __loader__.loadFile
+def load(*args, **kwargs):
+    '''
+    Loads an OBO file (see OboLoader.loadFile). Each call gets its own loader,
+    since loaders keep state, and loads may run in several threads at once.
+    '''
+    return OboLoader().loadFile(*args, **kwargs)
 
 #------------------------------------
 
 if __name__ == "__main__":
-    o = load(sys.argv[1], True)
+    #
+    # Usage: python Ontology.py file.obo
+    # Loads the file minimally with both the line-oriented parser and the
+    # stream parser, and reports the time for each.
+    #
+    def bench(streamMinimal):
+        ldr = OboLoader()
+        ldr.streamMinimal = streamMinimal
+        t0 = time.time()
+        o = ldr.loadFile(sys.argv[1], cullObsolete=True, loadMinimal=True)
+        t1 = time.time()
+        nedges = len(list(o.iterEdges()))
+        print("%s: %d terms, %d edges, %1.2f sec" % (
+            streamMinimal and "OboStreamParser" or "OboParser",
+            len(o.nodes), nedges, t1-t0))
+        return o
+    o1 = bench(False)
+    o2 = bench(True)
@@ -19,6 +19,12 @@
 import sys
 import types
 import os
+import time
+import json
+import html
+import subprocess
+import traceback
+import concurrent.futures
 import urllib.parse
 
 # Vlad libs
@@ -55,6 +61,17 @@ def write(vlad, fname, results, summary):
 def makeLink(label, url, target="_self"):
     return '<a href="%s" target="%s">%s</a>'%(url,target,label)
 
+def makeImageSrc(name, localurlroot, staticurlroot=None):
+    '''
+    Returns the src attribute for one of Vlad's static images. If there's a
+    shared static url, refers to that, falling back to the copy under
+    localurlroot (e.g., when the results are viewed from the zip file).
+    '''
+    local = "%s/%s" % (localurlroot, name)
+    if not staticurlroot:
+        return 'src="%s"' % local
+    return 'src="%s/%s" onerror="this.onerror=null;this.src=\'%s\';"' % (staticurlroot.rstrip('/'), name, local)
+
 #-------------------------------------------------------------------
 class ResultsWriter(object):
     extensions = []
@@ -82,7 +99,7 @@ class ResultsWriter(object):
     def openOutputFile(self, fname):
         self.filesWritten.append(fname)
         if self.fname == "-":
-            ofd = sys.stdout
+            ofd = self.vlad.stdout
         elif type(fname) is str:
             ofd = open(fname, 'w')
         elif hasattr(fname, "write") and callable(getattr(fname, "write")):
@@ -100,7 +117,7 @@ class ResultsWriter(object):
         self.registerBatchUrl()
 
     def closeFile(self, fp):
-        if fp is not sys.stdout:
+        if fp is not self.vlad.stdout:
             fp.close()
 
     def parseUrl(self, url):
@@ -318,9 +335,25 @@ class HTMLWriter(ResultsWriter):
         fd.close()
         return imap
 
+    def getInlineSvg(self, fname):
+        '''
+        Returns the <svg> element from an SVG file (i.e., without the XML
+        declaration and DOCTYPE), for including in the page.
+        '''
+        fd = open(fname, 'r')
+        svg = fd.read()
+        fd.close()
+        i = svg.find('<svg')
+        if i > 0:
+            svg = svg[i:]
+        return svg
+
+    def getImageSrc(self, name):
+        return makeImageSrc(name, self.imgurlroot, self.staticurlroot)
+
     def writeHtmlSummary(self, fp):
-        fp.write('<h1><img src="%s" align="middle" />' \
-            % (self.imgurlroot+"/vlad_logo.gif") )
+        fp.write('<h1><img %s align="middle" />' \
+            % self.getImageSrc(getattr(self.vlad.options, 'logofile', 'vlad_logo.gif')) )
         fp.write('<a name="top">%s</a></h1>\n' \
             % self.vlad.options.runname)
         fp.write('<table class="summary" cellspacing="0">')
@@ -330,7 +363,7 @@ class HTMLWriter(ResultsWriter):
 
     def _writeHtmlTable_(self, fp, ns, idsInMap):
         # write the results table for this namespace
-        greenballImg = '<img border="0" src="%s" />' % (self.imgurlroot+'/ball.gif')
+        greenballImg = '<img border="0" %s />' % self.getImageSrc('ball.gif')
         if self.vlad.options.gEnable:
             fp.write(f'<div style="font-size: smaller;">{greenballImg} A green dot indicates a term that also appears in the graph. ' \
                 + 'Click the dot to jump to that node (and vice versa).</div>' )
@@ -414,7 +447,13 @@ class HTMLWriter(ResultsWriter):
 
             # add image and clientside image map to section, if available
             imgfile, (imapfile,idsInMap) = self.ns2img.get(ns, [None,[None,None]])
-            if imgfile:
+            if imgfile and imgfile.endswith(".svg"):
+                # include the SVG itself, so its links can be scripted
+                # (see nodeClicked)
+                fp.write('<div id="img_%s" class="graph" onclick="showEdgeTypeLegend(event);">\n' % ns)
+                fp.write(self.getInlineSvg(imgfile))
+                fp.write('</div>\n<br/><br/>')
+            elif imgfile:
                 imgurl = self.imgurlroot+"/"+os.path.basename(imgfile) # use relative path for url
                 imgid = "img_"+ns
                 mapname = "map_"+ns
@@ -440,7 +479,7 @@ class HTMLWriter(ResultsWriter):
         fp.write('</table>\n')
 
         # include the edge legend 
-        legendurl = self.imgurlroot+"/legend.gif"
+        legendsrc = self.getImageSrc('legend.gif')
         fp.write('''<span id="edgetypelegend" 
                      class="edgetypelegend"
                      style="left:0;top:0;display:none;" 
@@ -450,18 +489,19 @@ class HTMLWriter(ResultsWriter):
                          <td style="text-align:center;"><b>Legend: Edge Types</b></td>
                          <td style="text-align:right;"><a href="http://www.geneontology.org/GO.ontology.relations.shtml" target="_blank">(details)</a></td>
                          </tr>
-                         <tr><td colspan="3"><img src="%s" /></td></tr>
+                         <tr><td colspan="3"><img %s /></td></tr>
                          </table>
-                     </span>\n''' % legendurl)
+                     </span>\n''' % legendsrc)
 
         # all done
         fp.write("</body>")
         fp.write("</html>")
         self.closeFile(fp)
 
-    def write(self, fname, results, summary, images = {}, imgurlroot=""):
+    def write(self, fname, results, summary, images = {}, imgurlroot="", staticurlroot=None):
         self.ns2img = images
         self.imgurlroot = imgurlroot
+        self.staticurlroot = staticurlroot
         ResultsWriter.write( self, fname, results, summary )
 
 __addImpl__(HTMLWriter)
@@ -545,44 +585,298 @@ class DOTWriter(ResultsWriter):
                     continue
                 terms.add(r.term)
 
-        # using these terms as starting points, extract the subgraph 
-        # consisting of the specified nodes (top 25 or whatever) and
-        # their ancestors.
-        sgext = DAG.SubgraphExtracter(inclusive=self.includeAncestors)
-        subgr = sgext.go(self.vlad.ontology, startNodes=terms, reversed=True)
-
-        if self.roi:
-            # if a ROI was specified, the following pass will remove
-            # any ancestors added by previous step that are not also in the ROI.
-            subgr = sgext.go(subgr, startNodes=self.roi)
+        # the selected terms, best first
+        ranked = []
+        seen = set()
+        for r in nsresults:
+            if r.term in terms and r.term not in seen:
+                seen.add(r.term)
+                ranked.append(r.term)
+                if len(ranked) == len(terms):
+                    break
 
-        # now use a Stylist to create a dot graph
-        dotgr = Stylist.Stylist().go(namespace, subgr, self.vlad, terms)
+        # If the graph is over the size limit ([DOT] maxNodes, maxEdges),
+        # cull it, and if that's not enough, keep only as many of the best
+        # terms as fit. (Layout time grows faster than the graph.)
+        cull = self.vlad.options.gCull
+        dotgr = self.makeGraph(namespace, terms, cull)
+        if not self.fits(dotgr):
+            adjustments = []
+            if not cull:
+                cull = True
+                adjustments.append("culled")
+                dotgr = self.makeGraph(namespace, terms, cull)
+            if not self.fits(dotgr) and len(ranked) > 1:
+                # find the most terms that fit
+                lo, hi = 0, len(ranked)
+                best = None
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    g = self.makeGraph(namespace, set(ranked[:mid]), cull)
+                    if self.fits(g):
+                        lo, best = mid, g
+                    else:
+                        hi = mid
+                n = max(lo, 1)
+                dotgr = best or self.makeGraph(namespace, set(ranked[:1]), cull)
+                adjustments.append("top %d of %d terms%s" % (n, len(ranked),
+                    self.describeCutoff(namespace, ranked[n-1])))
+            self.adjustments[namespace] = ", ".join(adjustments)
 
         # write the DOT graph to a .dot file
         GraphvizTools.DOTWriter().write(dotgr, fp)
         self.closeFile(fp)
 
-        # run dot over the graph file to generate image and imagemap files
+        # queue the dot runs that generate image and imagemap files. (See
+        # render().) Group the formats by font. (Arial and Helvetica have the
+        # same metrics, so they can share a layout.)
         dotfile=outputfile 
-        cgihome = None
-        if self.cfgParser.has_option("DOT","cgihome"):
-            cgihome = self.cfgParser.get("DOT","cgihome")
-        dr = GraphvizTools.DOTRunner( self.cfgParser.get("DOT", "executable"), cgihome )
         dargs = ["-q"]
         if self.maxImgSize:
             dargs.append("-Gsize="+self.maxImgSize)
+        fonts = []
+        font2outputs = {}
         for fmt,ext in self.additional:
             fn = dotfile[:-3] + ext 
             self.filesWritten.append(fn)
-            fmtOverrides = []
             if fmt == "eps":
-                fmtOverrides.append("-Nfontname=Helvetica")
+                font = "Helvetica"
             else:
-                fmtOverrides.append("-Nfontname=Arial")
-            dr.run( dotfile, fn, fmt, dargs+fmtOverrides )
+                font = "Arial"
+            if font not in font2outputs:
+                fonts.append(font)
+                font2outputs[font] = []
+            font2outputs[font].append((fmt,fn))
+        if not fonts:
+            return
+        layout = self.getLayout(dotgr, dotfile, dargs, fonts[0])
+        self.renders.append((namespace, dotfile, dargs, fonts, font2outputs, layout))
+
+    def makeGraph(self, namespace, terms, cull):
+        '''
+        Using terms as starting points, extracts the subgraph consisting of
+        the specified nodes (top 25 or whatever) and their ancestors, and
+        styles it. Returns the DOTDAG.
+        '''
+        ontology = self.vlad.ontology
+        if self.includeAncestors:
+            nodes = set()
+            for t in terms:
+                nodes |= ontology.getAncestors(t)
+        else:
+            nodes = set(terms)
+
+        if self.roi:
+            # if a ROI was specified, keep only those nodes that can be
+            # reached from the ROI without leaving the selected nodes.
+            # This removes any ancestors not also in the ROI.
+            nodes = ontology.getSweepOrder(nodes & self.roi, 
+                edgeFilt=lambda p,c,d: c in nodes)
+
+        subgr = ontology.subgraph(nodes)
+
+        # now use a Stylist to create a dot graph
+        return Stylist.Stylist().go(namespace, subgr, self.vlad, terms, cull)
+
+    def fits(self, dotgr):
+        '''
+        Returns True if the graph is within the size limit.
+        '''
+        return (not self.maxNodes or len(dotgr.node2subgraph) <= self.maxNodes) \
+           and (not self.maxEdges or len(dotgr.edge2subgraph) <= self.maxEdges)
+
+    def describeCutoff(self, namespace, term):
+        '''
+        Returns the cutoff that would keep term and the terms better than it,
+        e.g. " (Pval <= 1.2e-05)". Empty for topn and nmaxima cutoffs.
+        '''
+        rr = self.vlad.term2results[namespace].get(term, None)
+        if not rr:
+            return ""
+        if self.vlad.options.analysis == "percentage":
+            return " (max percentage >= %1.3g)" % rr[0].maxpval
+        elif self.cutoffType == "pval":
+            return " (min Pval <= %1.3g)" % rr[0].minpval
+        elif self.cutoffType == "qval":
+            return " (min Qval <= %1.3g)" % rr[0].minqval
+        return ""
+
+    def getDOTRunner(self):
+        cgihome = None
+        if self.cfgParser.has_option("DOT","cgihome"):
+            cgihome = self.cfgParser.get("DOT","cgihome")
+        return GraphvizTools.DOTRunner( self.cfgParser.get("DOT", "executable"), cgihome )
+
+    def getRenderCache(self):
+        '''
+        Returns the RenderCache for the output directory, or None if it's
+        turned off ([DOT] renderCacheSize, in MB).
+        '''
+        maxsize = self.cfgParser.getfloat("DOT", "renderCacheSize", fallback=0)
+        outputdir = getattr(self.vlad.options, "outputdir", None)
+        if maxsize <= 0 or not outputdir:
+            return None
+        return GraphvizTools.RenderCache(os.path.join(outputdir, "dotcache"), maxsize*1024*1024)
+
+    def getLayout(self, dotgr, dotfile, dargs, font):
+        '''
+        Looks for the graph's layout in the render cache. The layout depends
+        only on the graph's structure, sizes, and labels, not its colors, so a
+        graph that was drawn before in other colors (e.g., --gBackground,
+        --gNodeColor) has the same layout. Returns (key, positionedfile),
+        where key is the layout's key in the cache (None if layouts aren't
+        cached), and positionedfile is the graph written with the node and
+        edge positions from the cached layout (None if there isn't one).
+        '''
+        cache = self.renderCache
+        if not cache or "json0" not in self.dotRunner.getFormats():
+            return (None, None)
+        fd = open(dotfile, 'rb')
+        dottext = fd.read()
+        fd.close()
+        key = cache.makeKey(GraphvizTools.getLayoutText(dottext),
+            self.dotRunner.getVersion(), "json0", dargs+["-Nfontname="+font])
+        path = cache.getFile(key)
+        if path is None:
+            return (key, None)
+        try:
+            fd = open(path, 'r')
+            layout = json.load(fd)
+            fd.close()
+        except (OSError, ValueError):
+            return (key, None)
+        if not dotgr.setLayout(layout):
+            return (key, None)
+        pfile = dotfile[:-3] + "positioned.dot"
+        GraphvizTools.DOTWriter().write(dotgr, pfile)
+        return (key, pfile)
+
+    def render1(self, dotfile, dargs, fonts, font2outputs, layout, timeout):
+        '''
+        Runs dot to generate the files for one graph. The first group of
+        formats is laid out and rendered in one dot run, which also writes the
+        laid out graph; other groups are rendered from that without another
+        layout. If the layout was cached (see getLayout), all groups are
+        rendered from it. Raises subprocess.TimeoutExpired if it all takes
+        longer than timeout seconds, or subprocess.CalledProcessError if dot
+        fails. If all the files are in the cache, just links them. Files are
+        only added to the cache once every dot run has succeeded.
+        '''
+        dr = self.dotRunner
+        cache = self.renderCache
+        (layoutKey, positionedfile) = layout
+        tempfiles = [ positionedfile ]
+        try:
+            key2file = {}
+            if cache:
+                fd = open(dotfile, 'rb')
+                dottext = fd.read()
+                fd.close()
+                version = dr.getVersion()
+                for font in fonts:
+                    for fmt,fn in font2outputs[font]:
+                        key = cache.makeKey(dottext, version, fmt, dargs+["-Nfontname="+font])
+                        key2file[key] = fn
+                if cache.fetch(key2file):
+                    return
+            deadline = time.time() + timeout if timeout else None
+            def remaining():
+                if deadline is None:
+                    return None
+                return max(deadline - time.time(), 0.001)
+            if positionedfile:
+                for font in fonts:
+                    dr.runPositioned( positionedfile, font2outputs[font], dargs+["-Nfontname="+font], remaining() )
+            else:
+                layoutfile = None
+                jsonfile = None
+                outputs = font2outputs[fonts[0]]
+                if len(fonts) > 1:
+                    layoutfile = dotfile[:-3] + "layout.dot"
+                    outputs = outputs + [("dot",layoutfile)]
+                if layoutKey:
+                    jsonfile = dotfile[:-3] + "layout.json"
+                    outputs = outputs + [("json0",jsonfile)]
+                tempfiles += [ layoutfile, jsonfile ]
+                dr.runMulti( dotfile, outputs, dargs+["-Nfontname="+fonts[0]], remaining() )
+                if layoutfile:
+                    for font in fonts[1:]:
+                        dr.runPositioned( layoutfile, font2outputs[font], dargs+["-Nfontname="+font], remaining() )
+                if jsonfile and os.path.exists(jsonfile):
+                    cache.add(layoutKey, jsonfile)
+            for key, fn in key2file.items():
+                if os.path.exists(fn):
+                    cache.add(key, fn)
+        finally:
+            for f in tempfiles:
+                if f and os.path.exists(f):
+                    os.remove(f)
+
+    def renderPlaceholder(self, dr, namespace, dotfile, fonts, font2outputs, reason="Graph too large to draw"):
+        '''
+        Generates the files for a graph that couldn't be drawn, from a
+        graph with one node, saying so (and why).
+        '''
+        pfile = dotfile[:-3] + "placeholder.dot"
+        fd = open(pfile, 'w')
+        fd.write('digraph G {\n  graph [bgcolor="white"];\n'
+            '  node [shape=box, style=filled, fillcolor="#f0f0f0", fontsize=14];\n'
+            '  placeholder [label="%s: %s\\n'
+            'The DOT file is included with the results."];\n}\n' % (reason, namespace.replace('"', '')))
+        fd.close()
+        try:
+            for font in fonts:
+                dr.runMulti( pfile, font2outputs[font], ["-q", "-Nfontname="+font], 30 )
+        except (OSError, subprocess.SubprocessError):
+            # no placeholder, then. (The message says what happened.)
+            sys.stderr.write(traceback.format_exc())
+        finally:
+            os.remove(pfile)
+
+    def render(self):
+        '''
+        Runs dot for the queued graphs, several at a time ([DOT] processes).
+        A graph that takes longer than [DOT] timeout seconds is given up on,
+        and replaced by a placeholder.
+        '''
+        if not self.renders:
+            return
+        dr = self.dotRunner
+        cache = self.renderCache
+        nprocs = self.cfgParser.getint("DOT", "processes", fallback=3)
+        timeout = self.cfgParser.getfloat("DOT", "timeout", fallback=120) or None
+        nprocs = max(1, min(nprocs, len(self.renders)))
+        # (dot runs in its own process. A thread just waits for it.)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nprocs) as ex:
+            futures = [ ex.submit(self.render1, dotfile, dargs, fonts, f2o, layout, timeout)
+                for (ns, dotfile, dargs, fonts, f2o, layout) in self.renders ]
+            for (ns, dotfile, dargs, fonts, f2o, layout), f in zip(self.renders, futures):
+                try:
+                    f.result()
+                except subprocess.TimeoutExpired:
+                    self.renderPlaceholder(dr, ns, dotfile, fonts, f2o)
+                    self.vlad.addMessage(("The %s graph was too large to draw in %d seconds. "
+                        "Its DOT file (%s) is included in the results. For a smaller graph, "
+                        "use a stricter graph cutoff or a region of interest.") \
+                        % (ns, timeout, os.path.basename(dotfile)), "warning")
+                except subprocess.CalledProcessError as e:
+                    self.renderPlaceholder(dr, ns, dotfile, fonts, f2o, "Graph could not be drawn")
+                    msg = html.escape((e.stderr or b'').decode('utf-8', 'replace').strip().split('\n')[0])
+                    self.vlad.addMessage(("The %s graph could not be drawn (dot exited with status %d%s). "
+                        "Its DOT file (%s) is included in the results.") \
+                        % (ns, e.returncode, msg and ": " + msg or "", os.path.basename(dotfile)), "error")
+        self.renders = []
+        if cache:
+            cache.evict()
+            cache.close()
 
     def _writeFile_(self):
+        self.renders = []
+        self.adjustments = {}   # namespace -> how its graph was reduced
+        self.maxNodes = self.cfgParser.getint("DOT", "maxNodes", fallback=0)
+        self.maxEdges = self.cfgParser.getint("DOT", "maxEdges", fallback=0)
+        self.dotRunner = self.getDOTRunner()
+        self.renderCache = self.getRenderCache()
         nss = list(self.results.keys())
         nss.sort()
         for ns in nss:
@@ -591,6 +885,7 @@ class DOTWriter(ResultsWriter):
             fnbase,ext = os.path.splitext(tl)
             fn = os.path.join(hd, fnbase+"."+ns+ext)
             self._writeFile1_(ns, nsresults, fn)
+        self.render()
 
 __addImpl__(DOTWriter)
 
@@ -839,8 +1134,9 @@ function submitForm(idlist){
 }
 // Handler for clicks on nodes in the graph.
 // Find corresponding table row and scroll to it.
+// (areaElt is an <area> of the image map, or an <a> in an SVG graph.)
 function nodeClicked(areaElt,evt){
-    var h = areaElt.href;
+    var h = areaElt.getAttribute("href") || areaElt.getAttribute("xlink:href") || "";
     var i = h.lastIndexOf('#');
     if(i == -1)
         return true;
@@ -860,7 +1156,8 @@ function nodeClicked(areaElt,evt){
     return true;
 }
 function findAreaNode(id){
-    return document.getElementById("area_"+id);
+    return document.getElementById("area_"+id)
+        || document.querySelector('div.graph a[*|href="#'+id+'"]');
 }
 function findImgForArea(a){
     var map = a.parentNode;
@@ -871,7 +1168,18 @@ function findImgForArea(a){
 function hilightNode(id){
     var a = findAreaNode(id);
     var d = window.nodeHilightDiv;
-    if(a){
+    if(a && a.tagName.toLowerCase() == "a"){
+        // SVG node
+        var r = a.getBoundingClientRect();
+        var wscroll = getWindowScroll();
+        d.style.left = r.left + wscroll[0];
+        d.style.top  = r.top + wscroll[1];
+        d.style.width = r.width;
+        d.style.height = r.height;
+        d.style.display = "block";
+        d.scrollIntoView();
+    }
+    else if(a){
         var img = findImgForArea(a);
         if(! img) return;
         var coords = a.coords.split(",");
@@ -920,6 +1228,9 @@ window.onload = function(){
     document.body.appendChild(window.nodeHilightDiv);
     window.nodeHilightDiv.className = 'node-hilite';
     window.nodeHilightDiv.onclick = function(){ window.nodeHilightDiv.style.display="none"; };
+    var links = document.querySelectorAll('div.graph a');
+    for(var i = 0; i < links.length; i++)
+        links[i].onclick = function(evt){ return nodeClicked(this,evt); };
 }
 </script>
 '''     # t % (formid,idlistParamName)
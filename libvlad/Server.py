@@ -0,0 +1,331 @@
+#
+# Server.py
+#
+# A long running Vlad process that keeps ontologies, annotation sets, and
+# annotation closures in memory, and runs analyses sent to it over a Unix
+# domain socket. Loading a large annotation file and computing its closure
+# takes far longer than the analysis itself; as a CGI, Vlad pays that cost
+# on every request. With a server running, the CGI (www/vlad.py) just
+# forwards its arguments and copies back the output.
+#
+# Protocol: the client sends one line of JSON, {"args" : [ ... ]}, the same
+# argument list VladCGI.go() takes. The server answers with one line of JSON:
+# {"status" : "ok", "output" : "..."} or
+# {"status" : "error", "error" : "...", "traceback" : "...", "output" : "..."}.
+# Each request is handled in its own thread, so a long analysis doesn't hold
+# up the others. (Analyses for several annotation sets, --aSets, run in
+# parallel in forked worker processes.)
+#
+# Only registered annotation sets (and their ontologies) are kept. Uploaded
+# files are loaded per request, as before. A watcher thread checks the data
+# files periodically. When a file has changed (and then stayed the same for
+# one check, so a file being downloaded isn't read half written), the data
+# is reloaded in the background and swapped in as a whole; requests in the
+# meantime use the old copy. Closures of the old copy are discarded.
+#
+# The server also runs asynchronous jobs (see Jobs.py), in a pool of --workers
+# processes, which inherit the loaded data.
+#
+# Usage:
+#    python vlad-server.py -g config.cfg [-S socketfile] [--preload] [--interval secs] [--workers n]
+#
+#-------------------------------------------------------------------
+
+import sys
+import os
+import io
+import gc
+import json
+import weakref
+import time
+import socket
+import socketserver
+import threading
+import traceback
+import optparse
+import signal
+
+from .Vlad import VladCGI, ontologyLoader, annotationLoader
+from . import Analyzer
+from . import Jobs
+
+#-------------------------------------------------------------------
+
+class DataCache(object):
+    '''
+    Loaded data objects (ontologies, annotation sets), by key. Each entry
+    remembers the files it was loaded from, their modification times and sizes
+    at the time, and how to load it again.
+    '''
+    def __init__(self):
+        self.entries = {}       # key -> [ data, files, stamp, loader, pendingStamp ]
+        self.loading = {}       # key -> lock held while loading it
+        self.lock = threading.Lock()
+        # a forked child (e.g., a job) starts with fresh locks, in case
+        # another thread held one at the time.
+        os.register_at_fork(after_in_child=self.__afterfork__)
+
+    def __afterfork__(self):
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def stamp(self, files):
+        st = []
+        for f in files:
+            try:
+                s = os.stat(f)
+                st.append((s.st_mtime_ns, s.st_size))
+            except OSError:
+                st.append(None)
+        return tuple(st)
+
+    def get(self, key, files, loader):
+        '''
+        Returns the data for key, calling loader() to load it if it's not
+        already loaded. (If several threads ask for the same key at once,
+        one loads it and the others wait for it.)
+        '''
+        files = [ f for f in files if f ]
+        with self.lock:
+            e = self.entries.get(key, None)
+            if e:
+                return e[0]
+            klock = self.loading.setdefault(key, threading.Lock())
+        with klock:
+            with self.lock:
+                e = self.entries.get(key, None)
+            if e:
+                return e[0]
+            stamp = self.stamp(files)
+            data = loader()
+            with self.lock:
+                self.entries[key] = [data, files, stamp, loader, None]
+                self.loading.pop(key, None)
+        return data
+
+    def refresh(self):
+        '''
+        Reloads any entries whose files have changed, and have not changed
+        since the previous call. Returns the number reloaded.
+        '''
+        n = 0
+        with self.lock:
+            items = list(self.entries.items())
+        for key, e in items:
+            (data, files, stamp, loader, pending) = e
+            current = self.stamp(files)
+            if current == stamp or None in current:
+                e[4] = None
+            elif current != pending:
+                # changed. wait until it stops changing.
+                e[4] = current
+            else:
+                ndata = loader()
+                with self.lock:
+                    self.entries[key] = [ndata, files, current, loader, None]
+                Analyzer.__analyzer__.dropClosures(data)
+                e[0] = None
+                old = weakref.ref(data)
+                del data, ndata
+                gc.collect()
+                if old() is not None:
+                    # (requests still running with it will let it go when done)
+                    log("Warning: old copy of %s not yet freed after reload." % (key,))
+                n += 1
+        return n
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+#-------------------------------------------------------------------
+
+__cache__ = DataCache()
+__pid__ = os.getpid()
+
+class ServerVlad(VladCGI):
+    '''
+    VladCGI that gets registered annotation sets and their ontologies from the
+    data cache. (The cache keeps loader functions, not the ServerVlad, which
+    would otherwise live, with its results, as long as the entry.)
+    Runs the members of a multiple annotation set run in the server process,
+    one at a time, so they use the data cache, and the server never forks
+    a pool from a threaded process.
+    '''
+    MEMBERSINPROCESS = True
+
+    def loadData(self):
+        o = self.options
+        if not o.annotationconfig:
+            # uploaded or ad hoc files. Not cached.
+            VladCGI.loadData(self)
+            return
+        self.ontology = __cache__.get(
+            ('ontology', o.ontologyfile),
+            [o.ontologyfile],
+            ontologyLoader(o))
+        self.annotations = __cache__.get(
+            ('annotations', o.annotationfile, o.gpifile, o.memorybudget, getattr(o, 'ecomapping', None)),
+            [o.annotationfile, o.gpifile],
+            annotationLoader(o))
+
+#-------------------------------------------------------------------
+
+class VladRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            req = json.loads(line.decode('utf-8'))
+            if not isinstance(req, dict) or 'args' not in req:
+                raise ValueError('expected {"args" : [ ... ]}')
+            args = req['args']
+            if not isinstance(args, list) or not all([ isinstance(a, str) for a in args ]):
+                raise ValueError('args must be a list of strings')
+        except ValueError as e:
+            resp = { 'status' : 'error', 'error' : 'Bad request: %s' % e, 'output' : '' }
+        else:
+            try:
+                resp = self.server.run(args)
+            except Exception as e:
+                resp = { 'status' : 'error', 'error' : '%s: %s' % (e.__class__.__name__, e),
+                    'traceback' : traceback.format_exc(), 'output' : '' }
+        self.wfile.write((json.dumps(resp) + '\n').encode('utf-8'))
+
+class VladServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Serves Vlad requests on a Unix domain socket, each in its own thread.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socketfile, mode=0o660):
+        if os.path.exists(socketfile):
+            os.remove(socketfile)
+        socketserver.UnixStreamServer.__init__(self, socketfile, VladRequestHandler)
+        os.chmod(socketfile, mode)
+        self.socketfile = socketfile
+        self.nrequests = 0
+        self.lock = threading.Lock()
+
+    def run(self, args):
+        out = io.StringIO()
+        with self.lock:
+            self.nrequests += 1
+        try:
+            ServerVlad().go(list(args), out)
+            return { 'status' : 'ok', 'output' : out.getvalue() }
+        except (Exception, SystemExit) as e:
+            return {
+              'status' : 'error',
+              'error' : '%s: %s' % (e.__class__.__name__, e),
+              'traceback' : traceback.format_exc(),
+              'output' : out.getvalue() }
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socketfile):
+            os.remove(self.socketfile)
+
+#-------------------------------------------------------------------
+
+def watch(interval):
+    '''
+    Checks the data cache for changed files every interval seconds. (Runs in
+    a daemon thread.)
+    '''
+    while True:
+        time.sleep(interval)
+        try:
+            n = __cache__.refresh()
+            if n:
+                log("Reloaded %d data set(s)." % n)
+        except Exception:
+            log(traceback.format_exc())
+
+def preload(cfgfile):
+    '''
+    Loads every annotation set registered in the config file (and its ontology).
+    '''
+    v = ServerVlad()
+    v.parseArgs(['-g', cfgfile, '-a', '__none__', '-o', '__none__', '-q', '__none__'])
+    for name in sorted(v.options.aconfigs.__dict__.keys()):
+        t = time.time()
+        v = ServerVlad()
+        v.parseArgs(['-g', cfgfile, '-a', name, '-q', '__none__'])
+        v.loadData()
+        log("Loaded %s (%1.1f sec)." % (name, time.time()-t))
+
+def stop(signum, frame):
+    # shut down on SIGTERM as on ^C (not SystemExit, which requests catch).
+    # Worker processes (which inherit this handler) just exit.
+    if os.getpid() != __pid__:
+        os._exit(1)
+    raise KeyboardInterrupt()
+
+def log(msg):
+    sys.stderr.write("%s vlad-server: %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), msg))
+    sys.stderr.flush()
+
+#-------------------------------------------------------------------
+
+def request(socketfile, args, timeout=None):
+    '''
+    Sends args to the server listening on socketfile, and returns its response
+    (a dict, see above). Raises OSError if the server can't be reached.
+    '''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(socketfile)
+        s.sendall((json.dumps({ 'args' : args }) + '\n').encode('utf-8'))
+        fd = s.makefile('rb')
+        line = fd.readline()
+        fd.close()
+    finally:
+        s.close()
+    if not line:
+        raise OSError("No response from Vlad server: " + socketfile)
+    return json.loads(line.decode('utf-8'))
+
+#-------------------------------------------------------------------
+
+def main(argv):
+    op = optparse.OptionParser(usage="%prog -g config.cfg [-S socketfile] [--preload] [--interval secs] [--workers n]")
+    op.add_option("-g", "--config", dest="configfile", default=None,
+        help="Config file. Required.")
+    op.add_option("-S", "--socket", dest="socketfile", default=os.environ.get("VLAD_SOCKET", None),
+        help="Unix domain socket to listen on. Default: $VLAD_SOCKET.")
+    op.add_option("--preload", dest="preload", action="store_true", default=False,
+        help="Load all registered annotation sets at startup.")
+    op.add_option("--interval", dest="interval", type="float", default=60,
+        help="Seconds between checks for changed data files. Default=60.")
+    op.add_option("--workers", dest="workers", type="int", default=2,
+        help="Max number of asynchronous jobs to run at once. 0 = don't run jobs. Default=2.")
+    (options, args) = op.parse_args(argv[1:])
+    if not options.configfile:
+        op.error("No config file specified.")
+    if not options.socketfile:
+        op.error("No socket specified.")
+    cfgfile = os.path.abspath(options.configfile)
+    if options.preload:
+        preload(cfgfile)
+    t = threading.Thread(target=watch, args=(options.interval,))
+    t.daemon = True
+    t.start()
+    if options.workers > 0:
+        Jobs.JobRunner(Jobs.getJobStore(cfgfile), ServerVlad, options.workers).start()
+    global __pid__
+    __pid__ = os.getpid()
+    server = VladServer(options.socketfile)
+    signal.signal(signal.SIGTERM, stop)
+    log("Listening on %s." % options.socketfile)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -71,8 +71,8 @@ def sumLogs(start,end):
     '''
     global LOGCACHE, LENLOGCACHE, SUMLOGCACHE
     if end >= LENLOGCACHE:
-        for i in range( len(LOGCACHE), end+1000 ):
-            LOGCACHE.append(math.log(i))
+        # (build the longer list, then swap it in, in case of other threads)
+        LOGCACHE = LOGCACHE + [ math.log(i) for i in range( len(LOGCACHE), end+1000 ) ]
         LENLOGCACHE = len(LOGCACHE)
 
     key = (start,end)
@@ -39,6 +39,10 @@ class Stylist(object):
 
     def setNodeLink(self, n):
         self.dotdag.setObjAttr(n, 'URL', '#'+n.id)
+        if getattr(self.vlad.options, 'gFormat', 'png') == 'svg':
+            # the popup text. (For png, it's added to the image map.)
+            tip = self.vlad.getTermTooltip(n, self.namespace)
+            self.dotdag.setObjAttr(n, 'tooltip', tip.replace('"', "'"))
 
     def setNodeSize(self, n):
         #
@@ -333,7 +337,8 @@ class Stylist(object):
         # c'est finis
         return ''.join(clrbar)
 
-    def go(self, ns, dag, vlad, labelTerms):
+    def go(self, ns, dag, vlad, labelTerms, cull=None):
+        # cull: whether to cull interior nodes. Default: --gCull
         self.namespace = ns
         self.vlad = vlad
         self.doPercents = (vlad.options.analysis == "percentage")
@@ -397,7 +402,9 @@ class Stylist(object):
         for p,c,d in self.dotdag.iterEdges():
             self.setEdgeAttrs(p, c, d)
 
-        if self.vlad.options.gCull:
+        if cull is None:
+            cull = self.vlad.options.gCull
+        if cull:
             NodeCutter(self.labelTerms).go(dag=self.dotdag, allPaths=True)
             #culled = NodeCuller('minpval').go(dag=self.dotdag, allPaths=True)
             #NodeCutter(culled).go(dag=self.dotdag, allPaths=True)
@@ -486,6 +493,36 @@ class NodeCutter(DAG.Traversal):
     def getResults(self):
         return self.dag
 
+    # Sweeps the nodes in topological order rather than visiting every path.
+    # For each culled node, we carry along the set of nearest retained
+    # ancestors (over all paths); those get reconnected to the culled node's
+    # retained children.
+    def go(self, dag, startNodes=None, reversed=False, allPaths=False):
+        self.dag = dag
+        self.beforeTraverse(dag)
+        order = dag.getSweepOrder(startNodes)
+        for node in order:
+            if self.decider(dag, node, None):
+                self.nodesToCut.add(node)
+        swept = set(order)
+        retained = {}
+        for node in order:
+            if node not in self.nodesToCut:
+                continue
+            ancs = set()
+            for p in dag.iterParents(node):
+                if p in self.nodesToCut:
+                    ancs.update(retained.get(p, ()))
+                elif p in swept:
+                    ancs.add(p)
+            retained[node] = ancs
+            for c in dag.iterChildren(node):
+                if c not in self.nodesToCut:
+                    for n in ancs:
+                        self.edgesToAdd.add( (n, c, "...") )
+        self.afterTraverse(dag)
+        return self.getResults()
+
     def beforeTraverse(self, dag):
         self.nodesToCut = set()
         self.edgesToAdd = set()
@@ -507,17 +544,6 @@ class NodeCutter(DAG.Traversal):
 
         return False
 
-    def beforeNode(self, dag, node, path):
-        if self.decider(dag, node, path):
-            self.nodesToCut.add(node)
-
-    def afterEdge(self, dag, parent, child, data, path):
-        if child not in self.nodesToCut and parent in self.nodesToCut:
-            for (i, n) in enumerate(reversed(path)):
-                if i%2==0 and not n in self.nodesToCut:
-                    self.edgesToAdd.add( (n, child, "...") )
-                    break;
-
     def afterTraverse(self, dag):
         for n in self.nodesToCut:
             dag.removeNode(n)
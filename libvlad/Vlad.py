@@ -12,12 +12,28 @@ import optparse
 import time
 import configparser
 import tempfile
+import json
+import shutil
+import hashlib
+import sqlite3
+import zipfile
+import multiprocessing
+import concurrent.futures
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # Vlad libs
 from . import Annotation
+from . import Gpad
 from . import Ontology
 from . import Analyzer
 from . import ResultsWriter
+from . import GraphvizTools
+from . import FileTools
 from . import colors
 
 #-------------------------------------------------------------------
@@ -44,6 +60,9 @@ class Vlad(object):
         self.notfound = None
         self.messages = []
         self.summary = []
+        self.filters = {}
+        self.progressHandler = None
+        self.stdout = sys.stdout    # where the results (-O -, results message) go
         self.urlMap = {}
         self.batchUrlMap = {}
         self.initArgParser()
@@ -82,6 +101,14 @@ class Vlad(object):
             metavar="ANNOTATIONFILE", 
             help="Registered annot set name or a GAF format annotation file. (required)")
 
+        self.optParser.add_option(
+            "--gpi", 
+            dest="gpifile", 
+            default=None,
+            metavar="GPIFILE", 
+            help="GPI file. If given, the annotation file (-a) is in GPAD format, " + \
+                "and object information comes from GPIFILE.")
+
         self.optParser.add_option(
             "-o", 
             dest="ontologyfile", 
@@ -144,6 +171,16 @@ class Vlad(object):
                 "directly on the command line. Use -U to specify a file. " + \
                 "Optional. Default is to use entire database as universe set")
 
+        self.optParser.add_option(
+            "--usName",
+            dest="usname",
+            metavar="NAME",
+            action="callback",
+            type="string",
+            callback=self.parseUniverseSetNameArg,
+            help="Specifies a name for the preceding universe set (-u or -U). " + \
+                "The default name for a -U universe set is the name of the file.")
+
         self.optParser.add_option(
             "-x", 
             dest="exclude", 
@@ -154,6 +191,67 @@ class Vlad(object):
             metavar="CODE", 
             help="Evidence code(s) to exclude, e.g. '-x IEA'")
 
+        self.optParser.add_option(
+            "--taxon", 
+            dest="taxa", 
+            default=[],
+            action="append",
+            metavar="TAXA", 
+            help="Only use annotations to objects of the given taxon/taxa, " + \
+                "e.g. '--taxon 10090'. Repeatable.")
+
+        self.optParser.add_option(
+            "--assignedBy", 
+            dest="assignedby", 
+            default=[],
+            action="append",
+            metavar="SOURCES", 
+            help="Only use annotations assigned by the given source(s), " + \
+                "e.g. '--assignedBy MGI'. Repeatable.")
+
+        self.optParser.add_option(
+            "--objType", 
+            dest="objtypes", 
+            default=[],
+            action="append",
+            metavar="TYPES", 
+            help="Only use annotations to objects of the given type(s), " + \
+                "e.g. '--objType protein'. Repeatable.")
+
+        self.optParser.add_option(
+            "--since", 
+            dest="since", 
+            default=None,
+            metavar="DATE", 
+            help="Only use annotations made on or after DATE (YYYYMMDD or YYYY-MM-DD).")
+
+        self.optParser.add_option(
+            "--loadProcs", 
+            dest="loadprocs", 
+            default=None,
+            type="int",
+            metavar="N", 
+            help="Number of processes to use for parsing large annotation files. (default=1)")
+
+        self.optParser.add_option(
+            "--multiProcesses", 
+            dest="multiprocesses", 
+            default=None,
+            type="int",
+            metavar="N", 
+            help="Max number of annotation sets (--aSets) analyzed at once. " + \
+                "(default=number of CPUs)")
+
+        self.optParser.add_option(
+            "--memoryBudget", 
+            dest="memorybudget", 
+            default=None,
+            metavar="MB", 
+            help="Hold annotations on disk, using about MB megabytes of memory " + \
+                "for them while loading. (The budget is approximate: it is based " + \
+                "on the measured size of the first records loaded.) " + \
+                "(default=load into memory)")
+
         self.optParser.add_option(
             "-O", 
             dest="outputfiles", 
@@ -165,9 +263,9 @@ class Vlad(object):
     def parseArgs(self, args):
         (self.options, xxx) = self.optParser.parse_args(args)
         self.readConfig(self.options.configfiles)
-        if self.options.ontologyfile is None:
+        if self.options.ontologyfile is None and not getattr(self.options, 'asets', None):
             self.optParser.error("No ontology file specified.")
-        if self.options.annotationfile is None:
+        if self.options.annotationfile is None and not getattr(self.options, 'asets', None):
             self.optParser.error("No annotation file specified.")
         if len(self.options.qsets) == 0:
             self.optParser.error("No query set(s) specified. At least one -q or -f is required.")
@@ -193,6 +291,8 @@ class Vlad(object):
             asconfig = getattr(self.options.aconfigs, asname)
             self.options.annotationconfig = asconfig
             self.options.annotationfile = asconfig.file
+            if asconfig.gpi:
+                self.options.gpifile = asconfig.gpi
             self.options.ontologyconfig = asconfig.ontology
             self.options.ontologyfile = asconfig.ontology.file
         else:
@@ -259,6 +359,12 @@ class Vlad(object):
                     o.batchurl = config.get(sn, 'batchurl')
                 o.label = config.get(sn, 'name')
                 o.file = config.get(sn, 'file')
+                # if set, file is GPAD and this is the GPI
+                o.gpi = config.get(sn, 'gpi', fallback=None)
+                # optional ingest filters
+                o.taxa = config.get(sn, 'taxa', fallback='').split()
+                o.dbs = config.get(sn, 'dbs', fallback='').split()
+                o.objtypes = config.get(sn, 'objtypes', fallback='').split()
                 oname = config.get(sn, 'ontology')
                 o.ontology = getattr(oconfigs, oname)
         return aconfigs
@@ -295,12 +401,29 @@ class Vlad(object):
         parser.values.uset = uset
         parser.values.usname = dfltusname
 
+    def parseUniverseSetNameArg(self, option, opt_str, value, parser):
+        parser.values.usname = value
+
     def parseIdList(self, idString):
         return [_f for _f in re.split(r'[^a-zA-Z0-9_:.-]+', idString) if _f]
 
     def parseExcludeList(self, value):
         return [_f for _f in re.split( r'\W+', value.upper() ) if _f]
 
+    def getAnnotationFilters(self):
+        '''
+        Returns the annotation filter options as a dict of keyword
+        args for AnnotationSet.getFilter.
+        '''
+        def split(values):
+            return [_f for v in values for _f in re.split(r'[\s,]+', v) if _f]
+        return {
+            'taxa'       : [t.replace('taxon:','') for t in split(self.options.taxa)],
+            'assignedBy' : split(self.options.assignedby),
+            'objtypes'   : split(self.options.objtypes),
+            'since'      : (self.options.since or '').replace('-','').strip(),
+            }
+
     def readFile(self, fname):
         fd = open(fname, 'r')
         results = fd.read()
@@ -344,6 +467,14 @@ class Vlad(object):
         excluded = ','.join(self.options.exclude)
         if excluded == '':
             excluded = '(none - all codes included)'
+        #
+        filters = []
+        for (n,label) in [('taxa','taxon'), ('assignedBy','assigned by'), ('objtypes','object type')]:
+            if self.filters[n]:
+                filters.append('%s=%s' % (label, ','.join(self.filters[n])))
+        if self.filters['since']:
+            filters.append('since %s' % self.filters['since'])
+        filters = '; '.join(filters) or '(none)'
 
         # Reports QS summary data.
         qsval = []
@@ -362,6 +493,7 @@ class Vlad(object):
             ("Annotation date", adate),
             ("Analysis type", self.options.analysis),
             ("Excluded evidence codes", excluded),
+            ("Annotation filters", filters),
             ("Number of query sets", str(len(self.qsets))),
             ] + qsval
 
@@ -370,15 +502,38 @@ class Vlad(object):
         else:
             self.summary.append( ("Universe set", "default (everything)"))
 
+    def loadData(self):
+        '''
+        Loads the ontology and the annotations.
+        '''
+        self.ontology = self.loadOntology()
+        self.annotations = self.loadAnnotations()
+
+    def loadOntology(self):
+        return ontologyLoader(self.options)()
+
+    def loadAnnotations(self):
+        return annotationLoader(self.options)()
+
+    def setProgress(self, phase, percent):
+        '''
+        Reports how far along this run is. If there is a progressHandler
+        (e.g., see Jobs.runJob), calls it with the phase (a short description)
+        and percent complete.
+        '''
+        if self.progressHandler:
+            self.progressHandler(phase, percent)
+
     def analyze(self):
-        self.ontology = Ontology.load( 
-                self.options.ontologyfile, cullObsolete=True, loadMinimal=True, config=self.options.ontologyconfig)
-        self.annotations = Annotation.load( self.options.annotationfile, config=self.options.annotationconfig )
+        self.setProgress("loading data", 5)
+        self.loadData()
+        self.setProgress("analyzing", 30)
         self.resolveQsets()
         self.resolveUset()
+        self.filters = self.getAnnotationFilters()
         self.notfound, self.results, self.term2results = Analyzer.analyze(
                 self.qsets, self.options.qsnames, self.uset, self.ontology, self.annotations,
-                self.options.exclude, self.options.analysis)
+                self.options.exclude, self.options.analysis, self.filters)
         # check for no results in each namespace and remove before output
         for ns,rslts in list(self.results.items()):
           if len(rslts) == 0:
@@ -394,7 +549,14 @@ class Vlad(object):
             self.messages = []
         return rv
 
-    def go(self, args):
+    def go(self, args, out=None):
+        '''
+        Runs Vlad with the given command line. Output that would go to stdout
+        goes to out instead, if given (e.g., a StringIO, so several runs can
+        share a process).
+        '''
+        if out is not None:
+            self.stdout = out
         self.starttime = time.time()
         self.messages = []
         self.parseArgs(args)
@@ -405,10 +567,200 @@ class Vlad(object):
 
 #-------------------------------------------------------------------
 
+class VladBatch(Vlad):
+    '''
+    A subclass of Vlad for analyzing many query sets in one run, e.g., 
+    thousands of gene sets. The query sets are read from a file (-G),
+    either GMT (one set per line: name, description, ids...) or TSV 
+    (lines of: name, ids...; a set's ids may be spread over several lines).
+    The ontology and annotations are loaded once, and the annotation 
+    closures are computed once, before starting a pool of worker processes
+    (--procs), which inherit them. Each query set is analyzed separately
+    (as if it were the only one), and the results are streamed to a single
+    output file (-O), in TSV, NDJSON, or Parquet format (--format, or from 
+    the file's extension). No graphs, HTML, etc.
+    '''
+    COLUMNS = ['set', 'namespace', 'termId', 'termName', 'k', 'n', 'K', 'N', 'pval', 'qval', 'objects']
+    FORMATS = { 'tsv':'tsv', 'txt':'tsv', 'ndjson':'ndjson', 'jsonl':'ndjson', 'parquet':'parquet' }
+
+    def initArgParser(self):
+        Vlad.initArgParser(self)
+
+        self.optParser.add_option(
+            "-G",
+            "--sets",
+            dest="setsfile", 
+            default=None,
+            metavar="FILE", 
+            help="File of query sets, in GMT or TSV format. (required)")
+
+        self.optParser.add_option(
+            "--format",
+            dest="format", 
+            default=None,
+            help="Output format: tsv, ndjson, or parquet. (default: from output file name, else tsv)")
+
+        self.optParser.add_option(
+            "--procs",
+            dest="procs", 
+            default=1,
+            type="int",
+            metavar="N", 
+            help="Number of worker processes. (default=1)")
+
+        self.optParser.add_option(
+            "--maxP",
+            dest="maxp", 
+            default=1.0,
+            type="float",
+            metavar="P", 
+            help="Only output results with P-values <= P. (default=1, i.e., all)")
+
+    def parseArgs(self, args):
+        (self.options, xxx) = self.optParser.parse_args(args)
+        self.readConfig(self.options.configfiles)
+        if self.options.ontologyfile is None:
+            self.optParser.error("No ontology file specified.")
+        if self.options.annotationfile is None:
+            self.optParser.error("No annotation file specified.")
+        if self.options.setsfile is None:
+            self.optParser.error("No query sets file specified (-G).")
+        if len(self.options.outputfiles) != 1:
+            self.optParser.error("Exactly one output file (-O) required.")
+        self.outputfile = self.options.outputfiles[0]
+        fmt = self.options.format
+        if fmt is None:
+            fmt = self.FORMATS.get(self.outputfile.rsplit('.',1)[-1].lower(), 'tsv')
+        if fmt not in self.FORMATS.values():
+            self.optParser.error("Unknown output format: " + fmt)
+        if fmt == 'parquet' and pyarrow is None:
+            self.optParser.error("Parquet output requires the pyarrow module.")
+        if fmt == 'parquet' and self.outputfile == '-':
+            self.optParser.error("Cannot write Parquet to standard out.")
+        self.format = fmt
+        self.readSets(self.options.setsfile)
+
+    def readSets(self, fname):
+        '''
+        Reads the query sets file into self.options.qsets and self.options.qsnames.
+        '''
+        isgmt = fname.lower().endswith('.gmt')
+        name2ids = {}
+        fd = FileTools.openInput(fname, 'r')
+        for line in fd:
+            if line.startswith('#') or not line.strip():
+                continue
+            tokens = line.rstrip('\r\n').split('\t')
+            ids = name2ids.setdefault(tokens[0], [])
+            for t in tokens[isgmt and 2 or 1:]:
+                ids += self.parseIdList(t)
+        fd.close()
+        self.options.qsnames = list(name2ids.keys())
+        self.options.qsets = list(name2ids.values())
+
+    def analyzeSet(self, i):
+        '''
+        Analyzes the i-th query set. Returns a list of rows (lists of values, see COLUMNS).
+        '''
+        qsname = self.options.qsnames[i]
+        (qset, nf) = self.annotations.resolve(self.options.qsets[i])
+        notfound, results, term2results = Analyzer.analyze(
+                [qset], [qsname], self.uset, self.ontology, self.annotations,
+                self.options.exclude, self.options.analysis, self.filters)
+        rows = []
+        for ns in self.ontology.getNamespaces():
+            for r in results[ns]:
+                if r.pval <= self.options.maxp:
+                    rows.append([ qsname, ns, r.term.id, r.term.name, r.k, r.n, r.K, r.N,
+                        r.pval, r.qval, [x.getSymbol() for x in r.aList] ])
+        return rows
+
+    def getParquetSchema(self):
+        '''
+        Returns the pyarrow schema for Parquet output (see COLUMNS).
+        '''
+        types = [pyarrow.string()]*4 + [pyarrow.int64()]*4 + [pyarrow.float64()]*2 + [pyarrow.list_(pyarrow.string())]
+        return pyarrow.schema(list(zip(self.COLUMNS, types)))
+
+    def openOutput(self):
+        if self.format == 'parquet':
+            self.fd = None
+            self.pqwriter = None
+        elif self.outputfile == '-':
+            self.fd = self.stdout
+        else:
+            self.fd = open(self.outputfile, 'w')
+        if self.format == 'tsv':
+            self.fd.write('\t'.join(self.COLUMNS) + '\n')
+
+    def writeRows(self, rows):
+        if self.format == 'tsv':
+            for r in rows:
+                r = r[:8] + ['%0.2e' % r[8], '%0.2e' % r[9], ','.join(r[10])]
+                self.fd.write('\t'.join(map(str, r)) + '\n')
+        elif self.format == 'ndjson':
+            for r in rows:
+                self.fd.write(json.dumps(dict(list(zip(self.COLUMNS, r)))) + '\n')
+        elif rows:
+            schema = self.getParquetSchema()
+            table = pyarrow.Table.from_pydict(dict([ (c, [r[i] for r in rows]) for (i,c) in enumerate(self.COLUMNS) ]), schema=schema)
+            if self.pqwriter is None:
+                self.pqwriter = pyarrow.parquet.ParquetWriter(self.outputfile, schema)
+            self.pqwriter.write_table(table)
+
+    def closeOutput(self):
+        if self.format == 'parquet':
+            if self.pqwriter is None:
+                # no rows: still write the (empty) table
+                schema = self.getParquetSchema()
+                pyarrow.parquet.write_table(schema.empty_table(), self.outputfile)
+            else:
+                self.pqwriter.close()
+        elif self.fd is not self.stdout:
+            self.fd.close()
+
+    def go(self, args, out=None):
+        global __batch__
+        if out is not None:
+            self.stdout = out
+        self.starttime = time.time()
+        self.parseArgs(args)
+        self.loadData()
+        self.resolveUset()
+        self.filters = self.getAnnotationFilters()
+        # compute the closures now, so the workers share them
+        for ns in self.ontology.getNamespaces():
+            Analyzer.__analyzer__.computeAnnotationClosure(
+                self.ontology, ns, self.annotations, self.options.exclude, self.uset, self.filters)
+        self.openOutput()
+        n = len(self.options.qsets)
+        if self.options.procs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            __batch__ = self
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(self.options.procs) as pool:
+                for rows in pool.imap(analyzeBatchSet, range(n), chunksize=max(1, n // (self.options.procs*20))):
+                    self.writeRows(rows)
+            __batch__ = None
+        else:
+            for i in range(n):
+                self.writeRows(self.analyzeSet(i))
+        self.closeOutput()
+        self.endtime = time.time()
+        sys.stderr.write("Analyzed %d query sets in %1.2f sec\n" % (n, self.endtime-self.starttime))
+
+# The VladBatch running in this process (for the worker processes).
+__batch__ = None
+
+def analyzeBatchSet(i):
+    return __batch__.analyzeSet(i)
+
+#-------------------------------------------------------------------
+
 class TempFileCleaner(object):
-    def __init__(self, dir, age):
+    def __init__(self, dir, age, keep=()):
         self.dir = dir # directory to be purged
         self.age = age # max age; anything older will be removed
+        self.keep = set(keep) # names (in dir) to leave alone, e.g. unexpired runs
 
     def _ageCheck_(self, path):
         statinfo = os.stat(path)
@@ -417,18 +769,227 @@ class TempFileCleaner(object):
         
     def go(self):
         for sdRoot, sdSubdirs, sdFiles in os.walk(self.dir, topdown=False):
+            if os.path.relpath(sdRoot, self.dir).split(os.sep)[0] in self.keep:
+                continue
             for f in sdFiles:
                 path = os.path.join(sdRoot,f)
+                if f.startswith((RunManifest.FILENAME, GraphvizTools.RenderCache.INDEXFILE)) \
+                or (sdRoot == self.dir and f in self.keep):
+                    continue
                 if os.access(path, os.W_OK) and self._ageCheck_(path):
                     os.remove(path)
             for d in sdSubdirs:
                 path = os.path.join(sdRoot,d)
+                if sdRoot == self.dir and d in self.keep:
+                    continue
                 if os.access(path, os.W_OK) and len(os.listdir(path)) == 0:
                     os.rmdir(path)
         
 
 #-------------------------------------------------------------------
 
+class RunManifest(object):
+    '''
+    Index of the run directories (and job directories, etc.) in the output
+    directory, with their expiration times, kept in an SQLite database in the
+    output directory. Expiring old runs is then an indexed query, rather than
+    a walk of the whole output directory (see TempFileCleaner, which is still
+    used for a full sweep, e.g. for directories from before there was a manifest).
+    Entries are named by their path relative to the output directory.
+    The database also holds the result cache's entries (see ResultCache).
+    '''
+    FILENAME = "manifest.sqlite"
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.db = sqlite3.connect(os.path.join(dir, self.FILENAME), timeout=30, isolation_level=None)
+        try:
+            self.db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs (name TEXT PRIMARY KEY, expires REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS runs_expires ON runs (expires)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, name TEXT NOT NULL, " +
+            "size INTEGER NOT NULL, lastused REAL NOT NULL, messages TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_lastused ON cache (lastused)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_name ON cache (name)")
+
+    def getName(self, path):
+        name = os.path.relpath(path, self.dir)
+        if name.startswith(os.pardir) or os.path.isabs(name):
+            raise ValueError("Not in the output directory: " + path)
+        return name
+
+    def add(self, path, expires):
+        self.db.execute("INSERT OR REPLACE INTO runs (name, expires) VALUES (?, ?)",
+            (self.getName(path), expires))
+
+    def extend(self, path, expires):
+        self.db.execute("UPDATE runs SET expires = max(expires, ?) WHERE name = ?",
+            (expires, self.getName(path)))
+
+    def expire(self, now=None):
+        '''
+        Removes the entries (and their files) that expired before now (default:
+        the current time). Returns the number removed.
+        '''
+        if now is None:
+            now = time.time()
+        names = [ r[0] for r in self.db.execute("SELECT name FROM runs WHERE expires < ?", (now,)) ]
+        for name in names:
+            self.remove(name)
+        return len(names)
+
+    def remove(self, name):
+        '''
+        Removes the named entry, its files, and any result cache entries for it.
+        '''
+        path = os.path.join(self.dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        self.db.execute("DELETE FROM runs WHERE name = ?", (name,))
+        self.db.execute("DELETE FROM cache WHERE name = ?", (name,))
+
+    def getNames(self, now=None):
+        '''
+        Returns the names of the entries that have not expired as of now (default:
+        the current time).
+        '''
+        if now is None:
+            now = time.time()
+        return [ r[0] for r in self.db.execute("SELECT name FROM runs WHERE expires >= ?", (now,)) ]
+
+    def close(self):
+        self.db.close()
+
+#-------------------------------------------------------------------
+
+class ResultCache(object):
+    '''
+    Index of finished runs (output directories) by a key that hashes everything
+    that determines their output (see VladCGI.getCacheKey), so that a repeated
+    run can just return the existing directory.
+    Entries are kept in the output directory's RunManifest (the "cache" table):
+    the key, the name of the run directory, its size, its last use, and the
+    run's messages. Using an entry extends the run's expiration (see maxAge) in
+    the manifest. When the runs in the cache total more than maxsize bytes, the
+    least recently used ones are removed.
+    '''
+    def __init__(self, outputdir, maxsize, maxage):
+        self.outputdir = outputdir
+        self.maxsize = maxsize
+        self.maxage = maxage
+
+    def lookup(self, key):
+        '''
+        Returns the entry (a dict: dir, messages) for key, or None. Marks it
+        used, and extends the run's expiration.
+        '''
+        now = time.time()
+        m = RunManifest(self.outputdir)
+        try:
+            row = m.db.execute("SELECT cache.name, cache.messages FROM cache JOIN runs ON runs.name = cache.name " +
+                "WHERE cache.key = ? AND runs.expires >= ?", (key, now)).fetchone()
+            if row is None or not os.path.isdir(os.path.join(self.outputdir, row[0])):
+                return None
+            m.db.execute("UPDATE cache SET lastused = ? WHERE key = ?", (now, key))
+            m.extend(os.path.join(self.outputdir, row[0]), now + self.maxage)
+            return { 'dir' : row[0], 'messages' : json.loads(row[1]) }
+        finally:
+            m.close()
+
+    def add(self, key, rundir, messages):
+        size = 0
+        for sdRoot, sdSubdirs, sdFiles in os.walk(rundir):
+            for f in sdFiles:
+                size += os.path.getsize(os.path.join(sdRoot, f))
+        m = RunManifest(self.outputdir)
+        try:
+            m.db.execute("INSERT OR REPLACE INTO cache (key, name, size, lastused, messages) VALUES (?, ?, ?, ?, ?)",
+                (key, m.getName(rundir), size, time.time(), json.dumps(messages)))
+            self.evict(m)
+        finally:
+            m.close()
+
+    def evict(self, m):
+        '''
+        Removes the least recently used runs until the rest fit in maxsize.
+        '''
+        total = m.db.execute("SELECT total(size) FROM cache").fetchone()[0]
+        while total > self.maxsize:
+            row = m.db.execute("SELECT name, size FROM cache ORDER BY lastused LIMIT 1").fetchone()
+            if row is None:
+                break
+            m.remove(row[0])
+            total -= row[1]
+
+#-------------------------------------------------------------------
+
+class ResultsArchive(object):
+    '''
+    The zip file (<dir>/<dir name>.zip) of a run's output files. Files are
+    added as they are written (while they're still in the page cache), rather
+    than zipping the whole directory at the end. Member names are prefixed with
+    the directory name, as with "zip -r". Files that are already compressed
+    are stored as is.
+    '''
+    STORED = set(['.png', '.gif', '.jpg', '.xlsx', '.zip', '.gz'])
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.base = os.path.basename(dir)
+        self.filename = "%s.zip" % self.base
+        self.path = os.path.join(dir, self.filename)
+        self.zf = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        self.added = set()
+
+    def getArcName(self, path):
+        return os.path.join(self.base, os.path.relpath(path, self.dir))
+
+    def getCompression(self, name):
+        if os.path.splitext(name)[1].lower() in self.STORED:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def add(self, path):
+        '''
+        Adds the file (once).
+        '''
+        arcname = self.getArcName(path)
+        if arcname in self.added or path == self.path or not os.path.isfile(path):
+            return
+        self.added.add(arcname)
+        self.zf.write(path, arcname, compress_type=self.getCompression(path))
+
+    def addData(self, path, data):
+        '''
+        Adds data as the file path (which need not exist).
+        '''
+        arcname = self.getArcName(path)
+        if arcname in self.added:
+            return
+        self.added.add(arcname)
+        zi = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        zi.compress_type = self.getCompression(path)
+        zi.external_attr = 0o644 << 16
+        self.zf.writestr(zi, data)
+
+    def addTree(self, dir=None):
+        '''
+        Adds all files under dir (default: the run directory) not already added.
+        '''
+        for sdRoot, sdSubdirs, sdFiles in os.walk(dir or self.dir):
+            sdSubdirs.sort()
+            for f in sorted(sdFiles):
+                self.add(os.path.join(sdRoot, f))
+
+    def close(self):
+        self.zf.close()
+
+#-------------------------------------------------------------------
+
 class VladCGI(Vlad):
     '''
     A subclass of Vlad specialized for running as a CGI. 
@@ -441,6 +1002,12 @@ class VladCGI(Vlad):
     class ParameterError(RuntimeError):
         pass
 
+    # zip file of the output (see makeOutputDir)
+    archive = None
+
+    # contents of static files (images), by name, read once per process
+    staticFiles = {}
+
     class CGIArgParser(optparse.OptionParser):
         '''
         Subclass of OptionParser that raises our ParameterError class
@@ -507,6 +1074,14 @@ class VladCGI(Vlad):
             dest="outputdir", 
             help="Output directory." )
 
+        self.optParser.add_option(
+            "--aSets",
+            dest="asets", 
+            default=None,
+            metavar="NAMES",
+            help="Analyze against each of several registered annotation sets (comma separated " + \
+                "names, or 'all'), and combine the results into one report. Overrides -a and -o." )
+
         self.optParser.add_option(
             "--cleanTempFiles", 
             action="store_true",
@@ -521,6 +1096,12 @@ class VladCGI(Vlad):
             type="int",
             help="Maximum age (in days) before temp files are removed.")
 
+        self.optParser.add_option(
+            "--cacheSize",
+            dest="cachesize",
+            help="Max total size (in MB) of cached results, reused by identical runs. " + \
+                "0 = no caching. Default=0.")
+
         self.optParser.add_option(
             "--tExcel", 
             dest="tExcel", 
@@ -644,6 +1225,16 @@ class VladCGI(Vlad):
                 " Value is width and height, separated by comma, or a single " + \
                 " value that is used for both width and height. Units are inches. ")
 
+        self.optParser.add_option(
+            "--gFormat", 
+            dest="gFormat",
+            metavar="FORMAT",
+            type="choice",
+            default="png",
+            choices=["png","svg"],
+            help="Graph image format: png = PNG image with an image map, plus EPS; " + \
+                "svg = interactive SVG. (default=png)")
+
     def parseROIArg(self, option, opt_str, value, parser):
         parser.values.gROI = self.parseIdList(value)
 
@@ -668,6 +1259,31 @@ class VladCGI(Vlad):
         else:
             return None
 
+    def getTermTooltip(self, term, ns):
+        '''
+        Returns the text of the popup for term's node in the graph: its id,
+        name, and best score.
+        '''
+        rr = self.term2results[ns].get(term,None)
+        if rr:
+            if self.options.analysis == "percentage":
+                p = rr[0].maxpval
+                return "%s %s (%1.0f%%)"%(term.id, term.name, 100*p)
+            else:
+                p = rr[0].minpval
+                return "%s %s (%0.2e)"%(term.id,term.name,p)
+        return "%s %s"%(term.id,term.name)
+
+    def getIdsInSvg(self, fname):
+        '''
+        Returns the set of term ids linked from the nodes in an SVG graph
+        (see Stylist.setNodeLink).
+        '''
+        fd = open(fname, 'r')
+        text = fd.read()
+        fd.close()
+        return set(re.findall(r'href="#([^"]+)"', text))
+
     def fixClientSideImageMap(self, fname, ns):
         '''
         Reads a file containing a server side image map and rewrites
@@ -693,16 +1309,7 @@ class VladCGI(Vlad):
                 idsInMap.add(tid);
                 coords = tokens[2]+','+tokens[3]
                 term = self.ontology.getTerm(tid)
-                rr = self.term2results[ns].get(term,None)
-                if rr:
-                    if self.options.analysis == "percentage":
-                        p = rr[0].maxpval
-                        tiptext = "%s %s (%1.0f%%)"%(term.id, term.name, 100*p)
-                    else:
-                        p = rr[0].minpval
-                        tiptext = "%s %s (%0.2e)"%(term.id,term.name,p)
-                else:
-                    tiptext = "%s %s"%(term.id,term.name)
+                tiptext = self.getTermTooltip(term, ns)
                 areas.append(('<area id="area_%s" shape="rect" href="%s" coords="%s" ' + \
                         ' alt="%s" title="%s" onclick="return nodeClicked(this,event);" />') \
                              % (tid, href, coords, tiptext, tiptext))
@@ -710,13 +1317,41 @@ class VladCGI(Vlad):
         mapbody = '\n'.join(areas)
         mapname = "map_"+ns
         reslt = '<map name="%s">\n%s\n</map>\n' % (mapname, mapbody)
-        ofd = open(fname, 'w')
+        # (replace the file rather than overwrite it; it may be a link to a
+        # file in the render cache.)
+        tfname = fname + ".tmp"
+        ofd = open(tfname, 'w')
         ofd.write(reslt)
         ofd.close()
+        os.replace(tfname, fname)
         return idsInMap;
                 
+    def getManifest(self):
+        return RunManifest(self.options.outputdir)
+
     def cleanTempFiles(self):
-        TempFileCleaner(self.options.outputdir, self.options.maxage).go()
+        '''
+        Removes expired runs (see RunManifest). If maxAge is negative, removes
+        everything.
+        '''
+        m = self.getManifest()
+        if self.options.maxage < 0:
+            m.expire(float('inf'))
+            TempFileCleaner(self.options.outputdir, self.options.maxage).go()
+        else:
+            m.expire()
+        m.close()
+
+    def getGraphFormats(self):
+        '''
+        Returns the files to draw for each graph, as (format,extension) pairs
+        (see ResultsWriter.DOTWriter).
+        '''
+        if self.options.gFormat == "svg":
+            # links and popups are in the SVG itself; and it's vector
+            # graphics, so there's no need for EPS.
+            return [("svg","svg")]
+        return [("png","png"),("imap","map"),("eps","eps")]
 
     def generateGraphicalOutput(self):
         # if user specified a region of interest, first
@@ -735,10 +1370,8 @@ class VladCGI(Vlad):
                     msgs.append("?id not found: %s" % id)
 
             # get the descendents
-            self.ontology.traverse( 
-               startNodes=snodes,
-               beforeEdge=lambda g,p,c,d,h: d in ["is_a","part_of"],
-               beforeNode=lambda g,n,p: self.gROI.add(n))
+            self.gROI = set(self.ontology.getSweepOrder(snodes,
+               edgeFilt=lambda p,c,d: d in ["is_a","part_of"]))
 
             self.summary.append( ("Graph region of interest", "<br>".join(msgs)) )
 
@@ -749,14 +1382,14 @@ class VladCGI(Vlad):
             cutoff=self.options.gCutoff,
             includeAncestors = self.options.gIncAncestors,
             maxImgSize = self.options.gMaxImgSize,
-            additional=[("png","png"),("imap","map"),("eps","eps")])
+            additional=self.getGraphFormats())
         dw.write(os.path.join(self.myauxdir,"vlad.results.dot"), self.results, self.summary)
 
         # HACK: parse the names of files written by the DOTWriter. Build
         # a dict that maps namespace name (e.g., 'biological_process') to a
         # pair, [imagefile,imapfile], where imagefile is a complete path to
-        # an image file and imapfile is a complete path to an image map file
-        # that goes with the image. imapfile may be None.
+        # an image file (png or svg) and imapfile is a complete path to an
+        # image map file that goes with the image. imapfile may be None.
         ns2img = {}
         for n in dw.filesWritten:
             fn = os.path.basename(n)
@@ -766,16 +1399,22 @@ class VladCGI(Vlad):
                 ns = ".".join(fnparts[2:-1])
                 ext = fnparts[-1]
                 nsImg = ns2img.setdefault(ns, [None,None])
-                if ext == "png":
+                if ext == "png" or ext == "svg":
                     nsImg[0] = n
                 elif ext == "map":
                     nsImg[1] = n
 
-        # "fix" each image map file. (See method comments.)
+        # "fix" each image map file. (See method comments.) An SVG has its
+        # links and popups built in, and needs no map.
         for (ns, [ifile, mfile]) in list(ns2img.items()):
             if mfile:
                 idsInMap = self.fixClientSideImageMap(mfile, ns)
                 ns2img[ns][1] = [mfile,idsInMap]
+            elif ifile and ifile.endswith(".svg"):
+                ns2img[ns][1] = [None,self.getIdsInSvg(ifile)]
+
+        for n in dw.filesWritten:
+            self.addToArchive(n)
 
         # generate a "cutoff" summary message
         if self.options.analysis == "percentage":
@@ -796,6 +1435,14 @@ class VladCGI(Vlad):
         coff += "."
         if self.options.gCull:
             coff += "<BR/>Interior nodes have been culled."
+        if dw.adjustments:
+            limits = []
+            if dw.maxNodes:
+                limits.append("%d nodes" % dw.maxNodes)
+            if dw.maxEdges:
+                limits.append("%d edges" % dw.maxEdges)
+            coff += "<BR/>Reduced to fit the graph size limit (%s): %s." % (" and ".join(limits),
+                "; ".join([ "%s: %s" % (ns, dw.adjustments[ns]) for ns in sorted(dw.adjustments) ]))
         self.summary.append( ("Graph display", coff) )    
         #
         return ns2img
@@ -803,11 +1450,13 @@ class VladCGI(Vlad):
     def generateText(self):
         tw = ResultsWriter.TextWriter(self)
         tw.write(os.path.join(self.mydir,"results.tsv"), self.results, self.summary)
+        self.addToArchive(os.path.join(self.mydir,"results.tsv"))
 
     def generateExcel(self):
         xw = ResultsWriter.ExcelWriter(self)
         try:
             xw.write(os.path.join(self.mydir,"results.xlsx"), self.results, self.summary)
+            self.addToArchive(os.path.join(self.mydir,"results.xlsx"))
         except:
             self.addMessage("Error while generating spreadsheet. Excel file not written.","error")
 
@@ -815,28 +1464,59 @@ class VladCGI(Vlad):
         # generate the html file
         hw = ResultsWriter.HTMLWriter(self)
         hw.write(os.path.join(self.mydir,"results.html"), 
-                 self.results, self.summary, images, imgurlroot)
-        # copy the vlad logo image
-        lf = os.path.join(self.options.staticdir,self.options.logofile)
-        cmd = 'cp %s %s' % (lf, self.myauxdir)
-        os.system(cmd)
-        # copy the little green ball icon
-        lf = os.path.join(self.options.staticdir,"ball.gif")
-        cmd = 'cp %s %s' % (lf, self.myauxdir)
-        os.system(cmd)
-        # copy the edge-types legend
-        lf = os.path.join(self.options.staticdir,"legend.gif")
-        cmd = 'cp %s %s' % (lf, self.myauxdir)
-        os.system(cmd)
-
-
-    def zipCommand(self):
-        dir = self.mydir
-        pdir,based = os.path.split(dir)
+                 self.results, self.summary, images, imgurlroot, self.getStaticUrl())
+        self.addToArchive(os.path.join(self.mydir,"results.html"))
+        # the vlad logo, the little green ball icon, and the edge-types legend
+        self.addStaticFiles([self.options.logofile, "ball.gif", "legend.gif"])
+
+    def getStaticUrl(self):
+        '''
+        Returns the url of Vlad's static files (the build dir), if configured (vladUrl).
+        '''
+        return getattr(self.options, 'vladurl', None) or None
+
+    def getStaticFile(self, name):
+        if name not in self.staticFiles:
+            fd = open(os.path.join(self.options.staticdir, name), 'rb')
+            self.staticFiles[name] = fd.read()
+            fd.close()
+        return self.staticFiles[name]
+
+    def addStaticFiles(self, names):
+        '''
+        Provides the named static files (images) to this run's html. If there is a
+        shared static url (see getStaticUrl), the html refers to those, and the
+        files only go into the zip file (for viewing offline). Otherwise they are
+        written to the auxfiles directory.
+        '''
+        shared = self.getStaticUrl()
+        for name in names:
+            path = os.path.join(self.myauxdir, name)
+            try:
+                data = self.getStaticFile(name)
+            except OSError:
+                continue
+            if shared:
+                if self.archive:
+                    self.archive.addData(path, data)
+            else:
+                fd = open(path, 'wb')
+                fd.write(data)
+                fd.close()
+                self.addToArchive(path)
+
+    def addToArchive(self, path):
+        if self.archive:
+            self.archive.add(path)
+
+    def getZipFile(self):
+        '''
+        Returns the name and url of this run's zip file.
+        '''
+        based = os.path.basename(self.mydir)
         zfname = "%s.zip"%based
-        cmd = 'cd %s; zip -q -r %s %s; mv %s %s' % (pdir, zfname, based, zfname, based)
         zfurl = "%s/%s.zip"%(self.myurl,based)
-        return (cmd,zfname,zfurl)
+        return (zfname,zfurl)
 
     def output(self):
         '''
@@ -844,38 +1524,64 @@ class VladCGI(Vlad):
         and write a "Your results are ready" message to stdout.
         '''
 
-        # Poor-man's cleanup strategy... Each time we run, check for old temp files from
-        # prior runs, and remove them if they're more then some (24 hrs) age. See 'maxAge'
-        # config setting.
+        # Each time we run, remove output from prior runs that has expired, i.e., is
+        # more than some (24 hrs) age. See 'maxAge' config setting, and RunManifest.
         if self.options.cleanTempFiles:
             self.cleanTempFiles()
             if self.options.maxage < 0:
                 return
 
+        self.makeOutputDir()
+
+        # get the zip filename and url
+        (zfn, zfu) = self.getZipFile()
+
+        # create the output files (which are added to the zip file as they're written)
+        self.generateFiles()
+
+        # finish the zip file
+        self.setProgress("creating zip file", 95)
+        self.archive.close()
+
+        if getattr(self, 'resultCache', None):
+            self.resultCache.add(self.cacheKey, self.mydir, self.getMessages(clear=False))
+
+        self.printResults(zfn, zfu)
+
+    def makeOutputDir(self):
         # create my own temp directory
         prefix = "VLAD.%s." % re.sub( "[^-a-zA-Z0-9_]","_",self.options.runname)
         (self.mydir,self.myurl) = self.mkdtemp(suffix='', prefix=prefix)
+        m = self.getManifest()
+        m.add(self.mydir, time.time() + self.options.maxage)
+        m.close()
         # add a subdirectory "auxfiles"
         self.myauxdir = os.path.join(self.mydir,"auxfiles")
         self.myauxurl = "auxfiles"
         os.mkdir(self.myauxdir)
+        self.archive = ResultsArchive(self.mydir)
 
-        # get the comand to create the zip, plus filename and url
-        (zc, zfn, zfu) = self.zipCommand()
-
-        # create the output files
+    def generateFiles(self):
+        '''
+        Creates the output files (graphs, spreadsheet, text, html) in self.mydir.
+        '''
         images = {}
         if self.options.gEnable:
+            self.setProgress("drawing graphs", 50)
             images = self.generateGraphicalOutput()
+        self.setProgress("writing results", 80)
         if self.options.tExcel:
             self.generateExcel()
         if self.options.tText:
             self.generateText()
         self.generateHtml(images, self.myauxurl)
 
-        # actually create the zip file
-        os.system(zc)
-
+    def printResults(self, zfn, zfu, messages=None):
+        '''
+        Writes the "results are ready" message (with links) to self.stdout.
+        '''
+        if messages is None:
+            messages = self.getMessages()
         gendate=time.asctime(time.localtime(self.endtime))
         maxaged = self.options.maxage / (3600*24.0)
         exdate = time.asctime(time.localtime(self.endtime+self.options.maxage))
@@ -895,7 +1601,336 @@ class VladCGI(Vlad):
         %s <br/> Generated: %s; Expires: %s;
         %s
         </font>
-        '''%(lbl, viewLink, downloadLink, discardLink, zfn, gendate, exdate, self.getMessages()))
+        '''%(lbl, viewLink, downloadLink, discardLink, zfn, gendate, exdate, messages), file=self.stdout)
+
+    #
+    # Multiple annotation sets (--aSets)
+    #
+    def go(self, args, out=None):
+        if out is not None:
+            self.stdout = out
+        self.starttime = time.time()
+        self.messages = []
+        self.parseArgs(args)
+        if self.options.asets:
+            self.goMulti(args)
+            return
+        if self.getCachedRun():
+            return
+        self.analyze()
+        self.endtime = time.time()
+        self.summarize()
+        self.output()
+
+    #
+    # Result cache (--cacheSize)
+    #
+    # Options that don't affect the results, or are covered by getDataVersions.
+    NOCACHEKEY = set(['annotationfile', 'ontologyfile', 'gpifile', 'ecomapping', 'configfiles',
+        'oconfigs', 'aconfigs', 'annotationconfig', 'ontologyconfig', 'qsid2color',
+        'cleanTempFiles', 'maxage', 'cachesize', 'loadprocs', 'memorybudget'])
+
+    # Whether goMulti analyzes the annotation sets in this process (see ServerVlad).
+    MEMBERSINPROCESS = False
+
+    def getResultCache(self):
+        size = float(self.options.cachesize or 0)
+        if size <= 0 or self.options.maxage < 0:
+            return None
+        return ResultCache(self.options.outputdir, int(size*1024*1024), self.options.maxage)
+
+    def getRegisteredFiles(self):
+        '''
+        Returns the set of data and config files named in the configuration.
+        '''
+        registered = set(self.options.configfiles)
+        for a in vars(self.options.aconfigs).values():
+            registered.update([a.file, a.gpi])
+        for o in vars(self.options.oconfigs).values():
+            registered.add(o.file)
+        return registered
+
+    def getFileVersion(self, f, registered):
+        '''
+        Returns a version for file f: for registered files, its path, size and
+        modification time; for others (e.g. uploads, whose paths differ on every
+        request), its size and a hash of its contents.
+        '''
+        st = os.stat(f)
+        if f in registered:
+            return (f, st.st_size, st.st_mtime_ns)
+        h = hashlib.sha1()
+        fd = open(f, 'rb')
+        for block in iter(lambda: fd.read(1<<20), b''):
+            h.update(block)
+        fd.close()
+        return (st.st_size, h.hexdigest())
+
+    def getDataVersions(self):
+        '''
+        Returns a version for each input file (see getFileVersion).
+        '''
+        registered = self.getRegisteredFiles()
+        files = [self.options.annotationfile, self.options.gpifile, self.options.ontologyfile,
+            getattr(self.options, 'ecomapping', None)] + list(self.options.configfiles)
+        return [f and self.getFileVersion(f, registered) for f in files]
+
+    def getCacheKey(self):
+        '''
+        Returns a hash of this run's inputs: the options, the data versions, and Vlad's version.
+        Any other option naming an unregistered file is keyed on that file's contents,
+        not its path.
+        '''
+        registered = self.getRegisteredFiles()
+        opts = {}
+        for n,v in vars(self.options).items():
+            if n in self.NOCACHEKEY:
+                continue
+            if isinstance(v, str) and v not in registered and os.path.isfile(v):
+                v = self.getFileVersion(v, registered)
+            opts[n] = v
+        def canonical(v):
+            if isinstance(v, (set, frozenset)):
+                return sorted(v)
+            return repr(v)
+        s = json.dumps([VERSION, opts, self.getDataVersions()], sort_keys=True, default=canonical)
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    def getCachedRun(self):
+        '''
+        If the result cache has this run, prints its results message and
+        returns True.
+        '''
+        self.resultCache = self.getResultCache()
+        if self.resultCache is None:
+            return False
+        self.cacheKey = self.getCacheKey()
+        entry = self.resultCache.lookup(self.cacheKey)
+        if entry is None:
+            return False
+        self.mydir = os.path.join(self.options.outputdir, entry['dir'])
+        sep = (not self.options.outputdirurl.endswith("/") and "/" or "")
+        self.myurl = self.options.outputdirurl + sep + entry['dir']
+        self.endtime = time.time()
+        (zfn, zfu) = self.getZipFile()
+        self.messages = []
+        self.printResults(zfn, zfu, entry['messages'])
+        return True
+
+    def getAnnotationSetNames(self, value):
+        '''
+        Parses the --aSets value into a list of registered annotation set names.
+        '''
+        if value.strip().lower() == "all":
+            asets = list(self.options.aconfigs.__dict__.values())
+            asets.sort(key=lambda x: (int(x.order), x.name))
+            return [x.name for x in asets]
+        names = [_f for _f in re.split(r'[\s,]+', value) if _f]
+        for n in names:
+            if not hasattr(self.options.aconfigs, n):
+                raise VladCGI.ParameterError("Unknown annotation set: " + n)
+        return names
+
+    def goMulti(self, args):
+        '''
+        Analyzes the query set(s) against each of several registered annotation sets
+        (--aSets). Each annotation set is loaded and analyzed in its own process
+        (see runMember), up to --multiProcesses (at most one per CPU) at a time,
+        or, if MEMBERSINPROCESS, one after another in this process. Each writes
+        its usual output files into a subdirectory (named for the annotation set)
+        of this run's directory.
+        Then writes a combined report (results.html), a combined results.tsv
+        (if --tText), and a zip file of everything.
+        '''
+        names = self.getAnnotationSetNames(self.options.asets)
+        if self.options.cleanTempFiles:
+            self.cleanTempFiles()
+            if self.options.maxage < 0:
+                return
+        self.makeOutputDir()
+        (zfn, zfu) = self.getZipFile()
+        # member args: same as ours, without --aSets, plus -a
+        margs = []
+        skip = False
+        for a in args:
+            if skip:
+                skip = False
+            elif a == "--aSets":
+                skip = True
+            elif not a.startswith("--aSets="):
+                margs.append(a)
+        jobs = [ (self.__class__, margs + ["-a", n], os.path.join(self.mydir, n), self.myurl + "/" + n) for n in names ]
+        self.setProgress("analyzing %d annotation sets" % len(jobs), 5)
+        members = []
+        ex = None
+        if self.MEMBERSINPROCESS:
+            results = map(runAnnotationSetMember, jobs)
+        else:
+            # Not fork: the parent may have other threads (e.g. in the server),
+            # whose locks a forked child could inherit held.
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            ncpus = os.cpu_count() or 1
+            nworkers = max(1, min(len(jobs), ncpus, int(self.options.multiprocesses or ncpus)))
+            ex = concurrent.futures.ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx)
+            results = ex.map(runAnnotationSetMember, jobs)
+        try:
+            for m in results:
+                members.append(m)
+                self.setProgress("analyzed %s" % m[0], 5 + 85*len(members)//len(jobs))
+        finally:
+            if ex:
+                ex.shutdown()
+        for m in members:
+            self.messages += m[2]
+        self.endtime = time.time()
+        if self.options.tText:
+            self.generateMultiText(names, members)
+        self.generateMultiHtml(names, members)
+        self.setProgress("creating zip file", 95)
+        # (the members' files were written by other processes)
+        self.archive.addTree()
+        self.archive.close()
+        self.printResults(zfn, zfu)
+
+    def runMember(self, args, dir, url):
+        '''
+        Runs one member of a multiple annotation set run (see goMulti). Does a
+        complete analysis, with output files written in dir. Returns a tuple:
+        (label, summary, messages, top terms), where top terms is a list of
+        (namespace, term id, term name, score) for the best few terms in each namespace.
+        '''
+        self.starttime = time.time()
+        self.messages = []
+        self.parseArgs(args)
+        self.analyze()
+        self.endtime = time.time()
+        self.summarize()
+        (self.mydir, self.myurl) = (dir, url)
+        self.myauxdir = os.path.join(dir, "auxfiles")
+        self.myauxurl = "auxfiles"
+        os.makedirs(self.myauxdir)
+        self.generateFiles()
+        top = []
+        for ns in sorted(self.results.keys()):
+            seen = set()
+            for r in self.results[ns]:
+                if r.term not in seen and len(seen) < MULTITOPN:
+                    seen.add(r.term)
+                    score = self.options.analysis == "percentage" and r.maxpval or r.minpval
+                    top.append( (ns, r.term.id, r.term.name, score) )
+        return (self.options.annotationconfig.label, self.summary, self.messages, top)
+
+    def generateMultiText(self, names, members):
+        '''
+        Combines the members' results.tsv files into one, with an added Annotation set column.
+        '''
+        ofd = open(os.path.join(self.mydir, "results.tsv"), 'w')
+        ofd.write('# %s\n' % self.options.runname)
+        wroteHeader = False
+        for (n, m) in zip(names, members):
+            fname = os.path.join(self.mydir, n, "results.tsv")
+            if not os.path.exists(fname):
+                continue
+            ofd.write('# Annotation set = %s (%s)\n' % (n, m[0]))
+            fd = open(fname, 'r')
+            inHeader = True
+            for line in fd:
+                if line.startswith('# '):
+                    ofd.write('#   ' + line[2:])
+                elif inHeader:
+                    inHeader = False
+                    if not wroteHeader:
+                        ofd.write('Annotation set\t' + line)
+                        wroteHeader = True
+                else:
+                    ofd.write(n + '\t' + line)
+            fd.close()
+        ofd.close()
+
+    def generateMultiHtml(self, names, members):
+        '''
+        Writes the combined report: a section for each annotation set, with its
+        summary, its top terms, and a link to its full results.
+        '''
+        fp = open(os.path.join(self.mydir, "results.html"), 'w')
+        fp.write("<html><head>%s</head><body>" % ResultsWriter.CSSSTYLE)
+        fp.write('<h1><img %s align="middle" /><a name="top">%s</a></h1>\n' \
+            % (ResultsWriter.makeImageSrc(self.options.logofile, self.myauxurl, self.getStaticUrl()), self.options.runname))
+        summary = [
+            ("Vlad version", 'v%s'%VERSION),
+            ("Date", time.asctime(time.localtime(self.starttime))),
+            ("Run time", '%1.2f sec'%(self.endtime-self.starttime)),
+            ("Annotation sets", " | ".join([ResultsWriter.makeLink(m[0], "#"+n) for (n,m) in zip(names,members)])),
+            ("Number of query sets", str(len(self.options.qsets))),
+            ]
+        fp.write('<table class="summary" cellspacing="0">')
+        for lbl,val in summary:
+            fp.write('<tr><td class="label">%s:</td><td>%s</td></tr>'%(lbl,val))
+        fp.write('</table>\n')
+        fp.write(self.getMessages(clear=False))
+        for (n, (label, msummary, mmsgs, top)) in zip(names, members):
+            link = ResultsWriter.makeLink("full results", "%s/results.html" % n)
+            fp.write('<h3><a name="%s">%s</a> (%s | <a href="#top">top</a>)</h3>\n' % (n, label, link))
+            fp.write('<table class="summary" cellspacing="0">')
+            for lbl,val in msummary:
+                if not lbl.startswith("Query set"):
+                    fp.write('<tr><td class="label">%s:</td><td>%s</td></tr>'%(lbl,val))
+            fp.write('</table>\n')
+            if not top:
+                continue
+            fp.write('<table border="0" cellspacing="0" cellpadding="2" class="results">')
+            fp.write('<tr><th class="label">Namespace</th><th class="label">Term</th>' + \
+                '<th class="label">Name</th><th class="label">%s</th></tr>' \
+                % (self.options.analysis == "percentage" and "Max %" or "Min P"))
+            for (i, (ns, tid, tname, score)) in enumerate(top):
+                if self.options.analysis == "percentage":
+                    score = "%1.2f%%" % (100*score)
+                else:
+                    score = "%0.2e" % score
+                fp.write('<tr class="%s"><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' \
+                    % (["zlight","zdark"][i%2], ns, tid, tname, score))
+            fp.write('</table>\n')
+        fp.write("</body></html>")
+        fp.close()
+        self.addStaticFiles([self.options.logofile])
+
+# Number of top terms per namespace, per annotation set, shown in the combined report.
+MULTITOPN = 10
+
+def ontologyLoader(options):
+    '''
+    Returns a function that loads the ontology named in options (e.g., again
+    when its file changes; see Server.DataCache). It holds on to just the
+    file name and config, not the options.
+    '''
+    (file, config) = (options.ontologyfile, options.ontologyconfig)
+    def load():
+        return Ontology.load(file, cullObsolete=True, loadMinimal=True, config=config)
+    return load
+
+def annotationLoader(options):
+    '''
+    Returns a function that loads the annotations named in options (see
+    ontologyLoader).
+    '''
+    (file, gpifile, config) = (options.annotationfile, options.gpifile, options.annotationconfig)
+    budget = options.memorybudget and int(float(options.memorybudget)*1024*1024)
+    ecomapping = getattr(options, 'ecomapping', None)
+    nprocs = int(options.loadprocs or 1)
+    def load():
+        if gpifile:
+            return Gpad.load(file, gpifile, config=config, memoryBudget=budget, ecoMapping=ecomapping)
+        else:
+            return Annotation.load(file, config=config, nprocs=nprocs, memoryBudget=budget)
+    return load
+
+def runAnnotationSetMember(job):
+    (cls, args, dir, url) = job
+    try:
+        return cls().runMember(args, dir, url)
+    except Exception as e:
+        return (os.path.basename(dir), [], [("error", "%s: %s" % (os.path.basename(dir), e))], [])
 
 #-------------------------------------------------------------------
 class _blank_(object):
@@ -1,44 +1,168 @@
 # Wrapper for invoking vlad
+#
+# Runs as a CGI (vlad.cgi runs "python vlad.py"), or as a WSGI application
+# (the "application" callable below), e.g. under mod_wsgi:
+#    WSGIDaemonProcess vlad processes=4 threads=4
+#    WSGIScriptAlias /vlad/vlad.cgi /path/to/build/vlad.py process-group=vlad
+#    SetEnv VLAD_TMP ... (and the other VLAD_* settings from Configuration)
+# Under WSGI, the interpreter and libvlad stay around between requests.
+# Without a Vlad server, each request runs Vlad in its own thread, with its
+# output captured in a StringIO (see runVlad), so threads > 1 is fine.
+#
+# Uploaded files are streamed to temp files in $VLAD_TMP (see
+# libvlad/Multipart.py) and passed to Vlad by name.
+#
+# Commands (cmd=):
+#    analyze    runs Vlad and returns the results message (html)
+#    submit     queues the same run as a job (see libvlad/Jobs.py) and
+#               returns {"id" : jobid} (JSON). Needs the Vlad server, which
+#               runs the jobs; without it, returns a 503 error,
+#               {"error" : "...", "nojobs" : true}, and the page falls back
+#               to cmd=analyze.
+#    status     (job=jobid) returns the job's state, phase, percent complete,
+#               and when done, the results message (JSON)
 
 import sys
 import os
-import cgi
-import cgitb; cgitb.enable()
+import io
+import html
+import json
+import shutil
+import socket
+import time
+import traceback
 
 import libvlad
-import tempfile
-import atexit
+from libvlad import Multipart
+from libvlad import Jobs
 
-TMPDIR=os.environ.get("VLAD_TMP", "/tmp")
+def configFile():
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "config.cfg"))
 
-def removeTempFile(file):
-    os.remove(file)
+def tmpDir():
+    return os.environ.get("VLAD_TMP", "/tmp")
 
-def writeTempFile(contents):
-    fd,name = tempfile.mkstemp(dir=TMPDIR)
-    fp = os.fdopen(fd, 'wb')
-    fp.write(contents)
-    fp.close()
-    atexit.register( removeTempFile, name )
-    return name
+# If a Vlad server (bin/vlad-server.py) is listening on $VLAD_SOCKET, requests
+# are forwarded to it. Otherwise, Vlad runs in this process.
+def socketFile():
+    return os.environ.get("VLAD_SOCKET", None)
+
+# Seconds to wait for the Vlad server's answer. (Longer runs should be
+# submitted as jobs, cmd=submit.)
+def serverTimeout():
+    return float(os.environ.get("VLAD_SERVER_TIMEOUT", 600))
+
+def uploadedFile(form, name):
+    if name not in form or not form[name].filename:
+        raise RuntimeError("No file uploaded: " + name)
+    return form[name].path
 
 def handleUploads(form, args):
-    aname = writeTempFile(form['annotUploadFile'].value)
     args.append("-a")
-    args.append(aname)
+    args.append(uploadedFile(form, 'annotUploadFile'))
     oname = form['annotOntolSelect'].value
     if oname == '__upload__':
-        oname = writeTempFile(form['ontolUploadFile'].value)
+        oname = uploadedFile(form, 'ontolUploadFile')
     args.append("-o")
     args.append(oname)
 
-def runVlad(form):
+def connect():
+    '''
+    Returns a socket connected to the Vlad server, or None.
+    '''
+    sfile = socketFile()
+    if not sfile:
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(sfile)
+        return s
+    except OSError:
+        s.close()
+        return None
+
+def forward(args):
+    ''' 
+    Sends args to the Vlad server and returns its output, or None if
+    there is no server. Raises RuntimeError if the server doesn't answer
+    within serverTimeout() seconds.
+    '''
+    s = connect()
+    if s is None:
+        return None
+    s.settimeout(serverTimeout())
+    try:
+        s.sendall((json.dumps({ 'args' : args }) + '\n').encode('utf-8'))
+        fd = s.makefile('rb')
+        line = fd.readline()
+        fd.close()
+    except socket.timeout:
+        raise RuntimeError("Vlad server: no response in %d seconds." % serverTimeout())
+    finally:
+        s.close()
+    if not line:
+        raise RuntimeError("Vlad server: no response.")
+    resp = json.loads(line.decode('utf-8'))
+    if resp['status'] != 'ok':
+        raise RuntimeError("Vlad server: " + resp['error'] + "\n" + resp.get('traceback',''))
+    return resp['output']
+
+def runVlad(args):
+    '''
+    Runs Vlad (in the server, if there is one, else here) and returns its output.
+    '''
+    output = forward(args)
+    if output is None:
+        out = io.StringIO()
+        libvlad.VladCGI().go(args, out)
+        output = out.getvalue()
+    return output
+
+def submitJob(form):
+    '''
+    Queues a job for the submitted form. Returns (status, content type, body),
+    where body is the job id as JSON. Jobs are run by the Vlad server; if there
+    isn't one, nothing is queued, and the answer is a 503 error.
+    '''
+    s = connect()
+    if s is None:
+        return ('503 Service Unavailable', JSON, json.dumps({
+            'error' : 'Jobs are run by the Vlad server, which is not running.',
+            'nojobs' : True }))
+    s.close()
+    store = Jobs.getJobStore(configFile())
+    id = store.newJob()
+    # the uploads must outlive this request
+    jdir = store.jobDir(id)
+    for f in form.getUploads():
+        path = os.path.join(jdir, os.path.basename(f.path))
+        shutil.move(f.path, path)
+        f.path = path
+    store.submit(id, buildArgs(form))
+    return ('200 OK', JSON, json.dumps({ 'id' : id }))
+
+def jobStatus(form):
+    '''
+    Returns the state of the job named in the form, as JSON.
+    '''
+    store = Jobs.getJobStore(configFile())
+    id = form.getvalue('job', '')
+    if not store.exists(id):
+        raise RuntimeError("No such job: " + id)
+    job = store.read(id)
+    del job['args']
+    job['elapsed'] = (job['finished'] or time.time()) - job['submitted']
+    return json.dumps(job)
+
+def buildArgs(form):
+    '''
+    Returns the Vlad command line for the submitted form.
+    '''
     args = []
 
     # config file
-    cfgfile = os.path.abspath(os.path.join(os.path.dirname(__file__), "config.cfg"))
     args.append("-g")
-    args.append(cfgfile)
+    args.append(configFile())
 
     # when running as CGI, clean out temp files
     args.append("--cleanTempFiles")
@@ -54,7 +178,10 @@ def runVlad(form):
         args.append(form["analysis"].value)
 
     # annotation set
-    if "annotationset" in form:
+    if "allAnnotationSets" in form:
+        args.append("--aSets")
+        args.append("all")
+    elif "annotationset" in form:
         aset = form["annotationset"].value
         aset = aset.split(":",1)[0]
         if aset == "__upload__":
@@ -72,6 +199,13 @@ def runVlad(form):
         args.append("-x")
         args.append(val)
 
+    # annotation filters
+    for (fname, opt) in [("taxon","--taxon"), ("assignedBy","--assignedBy"), ("objType","--objType"), ("since","--since")]:
+        val = form.getvalue(fname, "").strip()
+        if val:
+            args.append(opt)
+            args.append(val)
+
     # query sets
     i=0
     while True:
@@ -84,8 +218,8 @@ def runVlad(form):
         qs = form[qsname]
         qsf = form[qsfname]
         if qsf.filename:
-            args.append("-q")
-            args.append(qsf.value.decode('utf-8'))
+            args.append("-f")
+            args.append(qsf.path)
         elif qs.value:
             args.append("-q")
             args.append(qs.value)
@@ -96,6 +230,10 @@ def runVlad(form):
         if qsn:
             args.append("-n")
             args.append(qsn)
+        elif qsf.filename:
+            # (else it would be named for the temp file)
+            args.append("-n")
+            args.append("qset%d" % i)
         #
         qsc = form[qscname].value
         if qsc:
@@ -105,8 +243,11 @@ def runVlad(form):
             
     # universe set
     if 'usfname' in form and form['usfname'].filename:
-        args.append("-u")
-        args.append(form['usfname'].value)
+        args.append("-U")
+        args.append(form['usfname'].path)
+        # (else it would be named for the temp file)
+        args.append("--usName")
+        args.append(os.path.basename(form['usfname'].filename.replace('\\', '/')) or "uploaded file")
     elif 'usids' in form:
         args.append("-u")
         args.append(form['usids'].value)
@@ -141,6 +282,10 @@ def runVlad(form):
         args.append("--gMaxImgSize")
         args.append(form.getvalue("gMaxImgSize"))
 
+    if "gFormat" in form:
+        args.append("--gFormat")
+        args.append(form.getvalue("gFormat"))
+
     if "gLabelEnable" in form:
         args.append("--gLabelEnable")
     else:
@@ -161,24 +306,78 @@ def runVlad(form):
     args.append("-O")
     args.append("-")
 
+    return args
+
+HTML = 'text/html; charset=utf-8'
+JSON = 'application/json; charset=utf-8'
+
+def errorPage():
+    '''
+    Returns an html page reporting the exception being handled.
+    '''
+    (etype, evalue, tb) = sys.exc_info()
+    return '<html><body><h2>Vlad error</h2><p>%s: %s</p><pre>%s</pre></body></html>\n' % (
+        html.escape(etype.__name__), html.escape(str(evalue)), html.escape(traceback.format_exc()))
+
+def handle(form):
+    '''
+    Handles a request. Returns (status, content type, body).
+    '''
     try:
-        libvlad.VladCGI().go(args)
-    except:
-        cgitb.handler()
+        if 'cmd' in form:
+            cmd = form['cmd'].value
+        else:
+            raise RuntimeError("No command.")
+        if cmd == "analyze":
+            return ('200 OK', HTML, runVlad(buildArgs(form)))
+        elif cmd == "submit":
+            return submitJob(form)
+        elif cmd == "status":
+            return ('200 OK', JSON, jobStatus(form))
+        else:
+            raise RuntimeError("Vlad: unknown command: "+cmd)
+    except Exception:
+        return ('500 Internal Server Error', HTML, errorPage())
 
 def main():
-    print("Content-type: text/html")
-    print()
-    form = cgi.FieldStorage()
-    if 'cmd' in form:
-        cmd = form['cmd'].value
+    ''' 
+    CGI entry point.
+    '''
+    try:
+        form = Multipart.parseForm(os.environ, sys.stdin.buffer, tmpDir())
+    except Exception:
+        (status, ctype, body) = ('400 Bad Request', HTML, errorPage())
     else:
-        raise RuntimeError("No command.")
-    if cmd == "analyze":
-        runVlad(form)
+        try:
+            (status, ctype, body) = handle(form)
+        finally:
+            form.cleanup()
+    sys.stdout.write("Status: %s\nContent-type: %s\n\n" % (status, ctype))
+    sys.stdout.write(body)
+
+def application(environ, start_response):
+    ''' 
+    WSGI entry point.
+    '''
+    for n,v in environ.items():
+        if n.startswith("VLAD") and isinstance(v, str):
+            os.environ.setdefault(n, v)
+    try:
+        form = Multipart.parseForm(environ, tmpdir=tmpDir())
+    except Exception:
+        (status, ctype, body) = ('400 Bad Request', HTML, errorPage())
     else:
-        raise RuntimeError("Vlad: unknown command: "+cmd)
+        try:
+            (status, ctype, body) = handle(form)
+        finally:
+            form.cleanup()
+    body = body.encode('utf-8')
+    start_response(status, [
+        ('Content-Type', ctype),
+        ('Content-Length', str(len(body))) ])
+    return [body]
 
 #----------------------
 
-main()
+if __name__ == "__main__":
+    main()